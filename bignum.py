@@ -0,0 +1,111 @@
+"""
+bignum.py
+
+Big integer arithmetic for the RSA operations in Sign and verify.
+
+Modular exponentiation of 4096-bit numbers is most of the CPU time of a sale, and GMP does it several times
+faster than Python's own longs, so the fastest backend available is picked at import: gmpy2, then gmpy, then
+the builtin pow. Each is checked against the builtin pow first, and skipped if it gets anything wrong.
+
+A PrivateKey does the private operation with the Chinese remainder theorem, as two half-size exponentiations,
+which is about four times faster than one with d. The input is blinded, so that the time taken says nothing about
+the key, and the result is checked with the public exponent before it is returned, since a fault in either half
+would give away the factors of n.
+
+The client (client/Dryer21Client.py, and its template in seller/templates) has a copy of the backends, the
+self-test and the selection, as it has to be a single file. Keep them in step with this one.
+"""
+
+import random
+
+def builtin_powmod(base, exponent, modulus):
+	return pow(base, exponent, modulus)
+
+def builtin_invert(a, modulus):
+	# Extended Euclid. Returns x with a * x = 1 mod modulus.
+	x, last_x, r, last_r = 0, 1, modulus, a % modulus
+	while r:
+		quotient = last_r / r
+		last_r, r = r, last_r - quotient * r
+		last_x, x = x, last_x - quotient * x
+	if last_r != 1:
+		raise ValueError("%r has no inverse mod %r" % (a, modulus))
+	return last_x % modulus
+
+def load_backends():
+	# Returns the available backends, fastest first, as (name, powmod, invert).
+	backends = []
+	try:
+		import gmpy2
+		backends.append(("gmpy2",
+			lambda base, exponent, modulus: long(gmpy2.powmod(base, exponent, modulus)),
+			lambda a, modulus: long(gmpy2.invert(a, modulus))))
+	except ImportError:
+		pass
+	try:
+		import gmpy
+		backends.append(("gmpy",
+			lambda base, exponent, modulus: long(pow(gmpy.mpz(base), exponent, modulus)),
+			lambda a, modulus: long(gmpy.invert(a, modulus))))
+	except ImportError:
+		pass
+	backends.append(("builtin", builtin_powmod, builtin_invert))
+	return backends
+
+def self_test(powmod, invert):
+	# Returns whether powmod and invert agree with the builtin ones, on random numbers of the sizes we use.
+	# A broken backend gets things wrong at every size, so a couple of rounds with short exponents is enough to catch
+	# it, and keeps this quick: it runs at the start of every process.
+	generator = random.Random(21)
+	for bits, rounds in ((64, 8), (1024, 2), (2048, 2), (4096, 2)):
+		for i in range(rounds):
+			modulus = generator.getrandbits(bits) | (1 << (bits - 1)) | 1
+			base, exponent = generator.getrandbits(bits) % modulus, generator.getrandbits(32) | 1
+			if powmod(base, exponent, modulus) != builtin_powmod(base, exponent, modulus):
+				return False
+			try:
+				expected = builtin_invert(base, modulus)
+			except ValueError:
+				continue
+			if invert(base, modulus) != expected:
+				return False
+	return True
+
+def select_backend():
+	for name, powmod, invert in load_backends():
+		if name == "builtin" or self_test(powmod, invert):
+			return name, powmod, invert
+		print "WARNING: bignum backend %s failed its self-test, not using it." % name
+
+backend, powmod, invert = select_backend()
+
+class PrivateKey:
+	def __init__(self, n, e, d, p, q):
+		self.n, self.e, self.d, self.p, self.q = n, e, d, p, q
+		assert p * q == n
+		self.dp, self.dq = d % (p - 1), d % (q - 1)
+		self.qinv = invert(q, p)
+		# Check the whole path against the plain private operation once, with the slow builtin pow.
+		x = random.SystemRandom().randint(2, n - 1)
+		if self.decrypt(x) != builtin_powmod(x, d, n):
+			raise ValueError("CRT private key operation is wrong for this key!")
+
+	@classmethod
+	def from_pycrypto(cls, key):
+		# From a Crypto.PublicKey.RSA private key.
+		return cls(key.n, key.e, key.d, key.p, key.q)
+
+	def crt(self, c):
+		m1 = powmod(c % self.p, self.dp, self.p)
+		m2 = powmod(c % self.q, self.dq, self.q)
+		h = self.qinv * (m1 - m2) % self.p
+		return m2 + h * self.q
+
+	def decrypt(self, c):
+		# c^d mod n.
+		r = random.SystemRandom().randint(2, self.n - 1)
+		blinded = c * powmod(r, self.e, self.n) % self.n
+		m = self.crt(blinded) * invert(r, self.n) % self.n
+		if powmod(m, self.e, self.n) != c % self.n:
+			raise ValueError("Private key operation failed its check!")
+		return m
@@ -0,0 +1,72 @@
+"""
+cache_lib.py
+
+Bounded in-memory caches for the services.
+
+An LRUCache holds up to size entries, and when it is full, adding one drops the entry that was used longest ago.
+It is safe to use from many threads at once. It counts its hits and misses, and stats returns them in a form
+that can be handed to rpc_lib.register_stats, so they show up in rpc_lib.py --stats.
+"""
+
+import collections, threading
+
+# What get returns for a key that isn't in the cache, since None can be a cached value.
+MISSING = object()
+
+class LRUCache:
+	def __init__(self, size):
+		self.size = size
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.hits = self.misses = self.evictions = 0
+		self.invalidations = 0
+
+	def get(self, key):
+		with self.lock:
+			value = self.entries.pop(key, MISSING)
+			if value is MISSING:
+				self.misses += 1
+				return MISSING
+			# Move it to the most recently used end.
+			self.entries[key] = value
+			self.hits += 1
+			return value
+
+	def peek(self, key):
+		# Like get, but without counting it, or counting as a use of the entry.
+		with self.lock:
+			return self.entries.get(key, MISSING)
+
+	def version(self):
+		# Returns a value to give put after reading something from its source, so that put can tell whether
+		# anything was invalidated in the meantime (see put).
+		with self.lock:
+			return self.invalidations
+
+	def put(self, key, value, version=None):
+		# If version is given, and anything has been invalidated since version() returned it, value may already be
+		# out of date, so it isn't stored. This is coarser than it needs to be, but can never keep a stale value.
+		with self.lock:
+			if version is not None and version != self.invalidations:
+				return
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		# Call this after the source has changed, not before, or a read in between could put the old value back.
+		with self.lock:
+			self.entries.pop(key, None)
+			self.invalidations += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				"size": len(self.entries),
+				"capacity": self.size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+			}
@@ -62,14 +62,18 @@ mkdir $JAIL/dryer21/data/collector_master_private_key
 mkdir $JAIL/dryer21/data/dispenser_address
 mkdir $JAIL/dryer21/data/dispenser_private_key
 mkdir $JAIL/dryer21/data/mixin_address
+mkdir $JAIL/dryer21/data/rpc_key
 
 # Initialize the starting databases.
 python setup_databases.py $JAIL
 
 fi
 
+# Bring the databases up to date with the code we're about to copy over.
+python setup_databases.py --upgrade $JAIL
+
 # Copy over required code.
-cp permissions.py rpc_lib.py global_storage.py verify.py dispenser.py collector.py $JAIL/dryer21/code/
+cp permissions.py rpc_lib.py rpc_eventloop.py db_lib.py cache_lib.py bignum.py global_storage.py verify.py dispenser.py collector.py $JAIL/dryer21/code/
 cp -r seller/ $JAIL/dryer21/code/
 cp -r redeemer/ $JAIL/dryer21/code/
 cp -r rpc_servers/ $JAIL/dryer21/code/
@@ -82,6 +86,12 @@ cp keys/collector_master_private_key.txt $JAIL/dryer21/data/collector_master_pri
 cp keys/dispenser_address.txt $JAIL/dryer21/data/dispenser_address/
 cp keys/dispenser_private_key.txt $JAIL/dryer21/data/dispenser_private_key/
 cp keys/mixin_address.txt $JAIL/dryer21/data/mixin_address/
+# The key TCP connections between services are authenticated with. Every host needs the same one.
+# It is made here the first time, readable only by root, and .gitignore keeps it out of the repository.
+if [ ! -f keys/rpc_key.txt ]; then
+    (umask 077 && openssl rand -hex 32 > keys/rpc_key.txt)
+fi
+cp keys/rpc_key.txt $JAIL/dryer21/data/rpc_key/
 
 # Make absolutely everything be owned by root to start with.
 chown -R 0:0 $JAIL
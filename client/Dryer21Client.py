@@ -95,7 +95,7 @@ def gen_bond(protobond):
 	"""
 	protobond = long_decode(protobond)
 	# Generate nonce's inverse, r^-1, from the stored nonce
-	nonce_inv = CryptoNumber.inverse(CryptoVars.nonce, CryptoVars.n)
+	nonce_inv = invert(CryptoVars.nonce, CryptoVars.n)
 	# BOND = (PROTOBOND * r^-1) = (m^d * r * r^-1) = (m^d) mod n
 	bond = (protobond * nonce_inv) % CryptoVars.n
 	# Encode the long for storage / display to the user
@@ -283,9 +283,70 @@ def inverse_OAEP(s):
 	return CryptoVars.OAEP_cipher.decrypt(s)
 
 def encrypt(s):
-	""" Wrapper around the encryption used by Crypto.PublicKey.RSA._RSAobj """
-	# (the second argument is ignored, according to PyCrypto docs)
-	return CryptoVars.key.encrypt(s, 0)[0]
+	""" The RSA public key operation, s^e mod n, as done by Crypto.PublicKey.RSA._RSAobj """
+	return powmod(s, CryptoVars.key.e, CryptoVars.n)
+
+# The big integer arithmetic for encrypt and gen_bond, on GMP when it is installed, which is much faster than
+# Python's own longs. Like the server's, a backend is only used once it has been checked against the builtin pow.
+# This is a copy of the server's bignum.py, trimmed to what the client needs: keep them in step.
+def builtin_invert(a, modulus):
+	""" Extended Euclid. Returns x with a * x = 1 mod modulus """
+	x, last_x, r, last_r = 0, 1, modulus, a % modulus
+	while r:
+		quotient = last_r / r
+		last_r, r = r, last_r - quotient * r
+		last_x, x = x, last_x - quotient * x
+	if last_r != 1:
+		raise ValueError('%r has no inverse mod %r' % (a, modulus))
+	return last_x % modulus
+
+def load_backends():
+	""" Returns the available backends, fastest first, as (name, powmod, invert) """
+	backends = []
+	try:
+		import gmpy2
+		backends.append(('gmpy2',
+			lambda base, exponent, modulus: long(gmpy2.powmod(base, exponent, modulus)),
+			lambda a, modulus: long(gmpy2.invert(a, modulus))))
+	except ImportError:
+		pass
+	try:
+		import gmpy
+		backends.append(('gmpy',
+			lambda base, exponent, modulus: long(pow(gmpy.mpz(base), exponent, modulus)),
+			lambda a, modulus: long(gmpy.invert(a, modulus))))
+	except ImportError:
+		pass
+	backends.append(('builtin', pow, builtin_invert))
+	return backends
+
+def self_test(powmod, invert):
+	""" Returns whether powmod and invert agree with the builtin ones, on random numbers of the sizes we use """
+	# A broken backend gets things wrong at every size, so a couple of rounds with short exponents is enough to catch
+	# it, and keeps this quick: it runs at the start of every process.
+	generator = random.Random(21)
+	for bits, rounds in ((64, 8), (1024, 2), (2048, 2), (4096, 2)):
+		for i in range(rounds):
+			modulus = generator.getrandbits(bits) | (1 << (bits - 1)) | 1
+			base, exponent = generator.getrandbits(bits) % modulus, generator.getrandbits(32) | 1
+			if powmod(base, exponent, modulus) != pow(base, exponent, modulus):
+				return False
+			try:
+				expected = builtin_invert(base, modulus)
+			except ValueError:
+				continue
+			if invert(base, modulus) != expected:
+				return False
+	return True
+
+def select_backend():
+	""" The fastest backend that passes its self-test. A wrong answer would make a bond that can't be redeemed """
+	for name, powmod, invert in load_backends():
+		if name == 'builtin' or self_test(powmod, invert):
+			return name, powmod, invert
+		print 'WARNING: bignum backend %s failed its self-test, not using it.' % name
+
+bignum_backend, powmod, invert = select_backend()
 
 def long_encode(n):
 	""" Encodes a long in a base64 string which is easily sendable / storable """
@@ -1,6 +1,6 @@
 """
 Collector: Moves BTC from the per-client generated payment reception wallets into the mixing wallet.into the mixing wallet.
-Iterates through the database to find entries where the bond has been sent. After double-checking that payment has indeed been sent, send it over to the mix-in wallet.
+Claims the entries where the bond has been sent and that haven't been swept yet from the database. After double-checking that payment has indeed been sent, send it over to the mix-in wallet, and mark the entry collected.
 
 Requires:
 - Database RPC
@@ -8,21 +8,100 @@ Requires:
 - Mix-in address
 - BTC seed (master private key)
 """
+import traceback
 import global_storage
 import bitcoin
 
-import rpc_lib
 from rpc_clients import Check, SellerDB
 
+# How many addresses to claim at a time. Each cycle works through the whole backlog, one batch at a time.
+CLAIM_BATCH = 500
+# How many old rows to move out of the seller database at a time (see SellerDB.expire_quotes).
+RETENTION_BATCH = 1000
+
 def collect():
+	while True:
+		claimed, failed = collect_batch()
+		# Stop at the end of the queue. Failed rows go back at the front, so stop on failures too, or we'd retry them forever.
+		if claimed < CLAIM_BATCH or failed:
+			return
+
+def collect_batch():
+	# Returns how many rows were claimed, and how many of those failed.
 	seed = global_storage.get_collector_master_private_key()
-	for row in SellerDB.get_rows_with_protobond_sent():
+	rows = SellerDB.claim_pending_collection(limit=CLAIM_BATCH)
+	failed = 0
+	# Fire off every check at once, so we aren't waiting on the network lookups one at a time.
+	# They skip Check's cache, since the balance has to be there now for us to sweep it.
+	checks = [Check.check_async(address=row['address'], price=global_storage.bond_price, use_cache=False) for row in rows]
+	for row, check in zip(rows, checks):
 		# A row is a dict with keys address and address_index
 		address, index = row['address'], row['address_index']
-		assert bitcoin.electrum_address(seed, index) == address
-		if Check.check(address=address, price=global_storage.bond_price): # Double-check that payment has indeed been sent
-			privkey = bitcoin.electrum_privkey(seed, index)
-			send_whole_wallet(privkey, global_storage.get_mixin_address())
+		try:
+			assert bitcoin.electrum_address(seed, index) == address
+			if check.result(): # Double-check that payment has indeed been sent
+				privkey = bitcoin.electrum_privkey(seed, index)
+				send_whole_wallet(privkey, global_storage.get_mixin_address())
+			else:
+				# We only issue protobonds once paid, so the money has already gone (e.g. swept before a crash).
+				print "Nothing to collect from %r." % address
+		except Exception:
+			# Leave it for the next cycle.
+			print "Failed to collect from %r:" % address
+			traceback.print_exc()
+			SellerDB.release_collection(address=address)
+			failed += 1
+			continue
+		SellerDB.mark_collected(address=address)
+	return len(rows), failed
+
+def retain():
+	# Expire old quotes and archive finished rows, with the default ages. Returns how many of each, how many
+	# old quotes turned out to have been paid, and how many to have been underpaid.
+	expired, paid, underpaid = expire_quotes()
+	archived = 0
+	while True:
+		count = SellerDB.archive_collected(limit=RETENTION_BATCH)
+		archived += count
+		if count < RETENTION_BATCH:
+			return expired, archived, paid, underpaid
+
+def expire_quotes():
+	# Only a quote whose address is empty is expired. One that was paid goes into the queue to be swept, and the
+	# client can still fetch its protobond. One that was paid only in part is marked underpaid, which takes it out
+	# of the expired quotes for good, and leaves it for someone to look into. The client may yet pay the rest and
+	# fetch its protobond. Returns how many were expired, how many were paid, and how many were underpaid.
+	expired = paid = underpaid = 0
+	after = None
+	while True:
+		page = SellerDB.get_expired_quotes_page(after=after, limit=RETENTION_BATCH)
+		rows = page["rows"]
+		# Most old quotes were never paid at all, so first look for anything in them, and only look again at the
+		# price for those that have something. Like collect_batch, these skip Check's cache.
+		nonempty = [Check.check_async(address=row['address'], price=1, use_cache=False) for row in rows]
+		empty, full, partial = [], [], []
+		for row, check in zip(rows, nonempty):
+			try:
+				if not check.result():
+					empty.append(row['address'])
+				elif Check.check(address=row['address'], price=row['price'], use_cache=False):
+					full.append(row['address'])
+				else:
+					partial.append(row['address'])
+			except Exception:
+				# Leave it for the next cycle.
+				print "Failed to check the expired quote for %r:" % row['address']
+				traceback.print_exc()
+		if full:
+			paid += SellerDB.mark_paid(addresses=full)
+		if empty:
+			expired += SellerDB.expire_quotes(addresses=empty)
+		if partial:
+			print "Quotes for %r ran out underpaid, and need handling by hand." % (partial,)
+			underpaid += SellerDB.mark_underpaid(addresses=partial)
+		after = page["next"]
+		if after is None:
+			return expired, paid, underpaid
 
 def send_whole_wallet(fromprivkey, toaddr):
 	transaction_fee = 20000 # .0002 BTC
@@ -38,3 +117,6 @@ if __name__ == "__main__":
 	while True:
 		time.sleep(60)
 		collect()
+		expired, archived, paid, underpaid = retain()
+		if expired or archived or paid or underpaid:
+			print "Expired %i quotes, found %i old quotes paid and %i underpaid, and archived %i collected rows." % (expired, paid, underpaid, archived)
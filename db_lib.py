@@ -0,0 +1,198 @@
+"""
+db_lib.py
+
+Long-lived sqlite3 connections for the database services.
+
+Opening a connection for every call means reading the schema and preparing every statement all over again,
+so a Database keeps its connections open instead, and sqlite3 caches the prepared statements on each of them.
+The file is put in WAL mode, where readers never block the writer or each other: reads go to a pool of
+connections, so any number can run at once, while writes all go through one connection, one transaction at a time.
+"""
+
+import base64, contextlib, hashlib, os, sqlite3, struct, threading, time, Queue
+import rpc_lib
+
+# The synchronous level for new Databases. In WAL mode, FULL syncs the log on every commit, so a committed
+# transaction survives even a power cut, while NORMAL only syncs at checkpoints: still safe against crashes of
+# the service itself, and much faster, but the last few commits can be lost if the whole machine goes down.
+SYNCHRONOUS = "FULL"
+# How long to wait on a lock held by some other process using the file (e.g. setup_databases.py), in seconds.
+BUSY_TIMEOUT = 10.0
+# How many prepared statements each connection keeps.
+STATEMENT_CACHE_SIZE = 64
+# How long a GroupCommit waits for more writes to join the first one in a transaction, in seconds,
+# and the most writes it puts in one transaction.
+GROUP_COMMIT_WINDOW = 0.003
+GROUP_COMMIT_MAX = 500
+
+class Database:
+	def __init__(self, path, synchronous=SYNCHRONOUS):
+		self.path, self.synchronous = path, synchronous
+		self.write_lock = threading.Lock()
+		self.writer = self.open()
+		# This is stored in the file, so it only really does anything the first time.
+		self.writer.execute("pragma journal_mode = wal")
+		self.readers = Queue.LifoQueue()
+
+	def open(self):
+		# Connections are handed between threads, but only ever used by one at a time.
+		conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+		conn.row_factory = sqlite3.Row
+		conn.execute("pragma synchronous = %s" % self.synchronous)
+		return conn
+
+	def read(self, sql, parameters=()):
+		# Run a query, and return a list of its rows.
+		try:
+			conn = self.readers.get_nowait()
+		except Queue.Empty:
+			conn = self.open()
+		try:
+			return conn.execute(sql, parameters).fetchall()
+		finally:
+			self.readers.put(conn)
+
+	def attach(self, path, name):
+		# Makes the database at path available to transactions, as name, e.g. "insert into name.table ...".
+		self.writer.execute("attach database ? as %s" % name, (path,))
+		self.writer.execute("pragma %s.journal_mode = wal" % name)
+		self.writer.execute("pragma %s.synchronous = %s" % (name, self.synchronous))
+
+	@contextlib.contextmanager
+	def transaction(self):
+		# with db.transaction() as conn: runs the block as one transaction on the write connection.
+		# It commits at the end of the block, or rolls back if the block raises.
+		with self.write_lock:
+			with self.writer:
+				yield self.writer
+
+# A database can be split into shards, each a file of its own with its own connections, so that writes to
+# different shards don't wait for each other. Each row goes in the shard picked by a hash of its key.
+# Shard 0 is the original file, and holds the number of shards, in its shards table (no table means 1).
+# The others are named after it: seller_database.db, seller_database.1.db, seller_database.2.db, ...
+# Change the number of shards with setup_databases.py --reshard.
+def shard_path(path, shard):
+	if shard == 0:
+		return path
+	base, extension = os.path.splitext(path)
+	return "%s.%i%s" % (base, shard, extension)
+
+def shard_of(key, count):
+	return struct.unpack(">I", hashlib.sha256(key).digest()[:4])[0] % count
+
+def shard_count(conn):
+	# conn is a connection to shard 0.
+	if not list(conn.execute("select 1 from sqlite_master where name = 'shards'")):
+		return 1
+	return conn.execute("select count from shards").fetchone()[0]
+
+def open_shards(path, synchronous=SYNCHRONOUS):
+	# Returns a Database for each shard of the database at path.
+	first = Database(path, synchronous)
+	return [first] + [Database(shard_path(path, shard), synchronous) for shard in range(1, shard_count(first.writer))]
+
+# Every commit waits for a sync to disk, so writing one row per transaction caps the write rate at the disk's sync rate.
+# A GroupCommit takes writes from any number of threads, and does all those that arrive within the window of each
+# other in a single transaction, on a thread of its own. Each write is write(conn, item), and its caller gets back
+# its own result, or exception, but only once the whole transaction has committed, so it is as durable as if it
+# had been alone. If the commit itself fails, every write in it fails with that error.
+# An exception from one write doesn't undo the others in its transaction, since sqlite3 only rolls back the
+# failing statement, so write must not leave things half done when it raises.
+# Callers wait no longer than the current RPC deadline (see rpc_lib.deadline), and get an RPCTimeout after it.
+# Writes whose deadline has passed by the time their transaction starts are skipped, but once it has started they
+# go ahead, so a timed out write may still have been committed.
+class GroupCommit:
+	def __init__(self, database, write, window=GROUP_COMMIT_WINDOW, max_size=GROUP_COMMIT_MAX):
+		self.database, self.write, self.window, self.max_size = database, write, window, max_size
+		self.queue = Queue.Queue()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+
+	def submit(self, item):
+		outcome = self.submit_many([item])[0]
+		if isinstance(outcome, Exception):
+			raise outcome
+		return outcome
+
+	def submit_many(self, items):
+		# Returns the outcome of writing each of items, which is its result, or the exception it failed with.
+		# All of them go in the same transaction.
+		with self.thread_lock:
+			# The thread is started on first use, so that it is started in each forked worker (see rpc_lib.spawn_worker).
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.run)
+				self.thread.daemon = True
+				self.thread.start()
+		done = threading.Event()
+		outcomes = [None] * len(items)
+		deadline = rpc_lib.current_deadline()
+		self.queue.put((items, outcomes, done, deadline))
+		if not done.wait(None if deadline is None else max(deadline - time.time(), 0)):
+			raise rpc_lib.RPCTimeout("Deadline expired waiting for a group commit, which may still commit the writes.")
+		return outcomes
+
+	def run(self):
+		while True:
+			group = [self.queue.get()]
+			size = len(group[0][0])
+			end = time.time() + self.window
+			while size < self.max_size:
+				try:
+					group.append(self.queue.get(timeout=max(end - time.time(), 0)))
+				except Queue.Empty:
+					break
+				size += len(group[-1][0])
+			self.commit(group)
+
+	def commit(self, group):
+		try:
+			with self.database.transaction() as conn:
+				for items, outcomes, done, deadline in group:
+					# Whoever is waiting for these has given up, so don't do them.
+					if rpc_lib.expired(deadline):
+						outcomes[:] = [rpc_lib.RPCTimeout("Deadline expired before the group commit started.")] * len(items)
+						continue
+					for i, item in enumerate(items):
+						try:
+							outcomes[i] = self.write(conn, item)
+						except Exception, e:
+							outcomes[i] = e
+		except Exception, e:
+			for items, outcomes, done, deadline in group:
+				outcomes[:] = [e] * len(items)
+		for items, outcomes, done, deadline in group:
+			done.set()
+
+# Byte strings (tokens, bonds and addresses) are stored as BLOBs, and address indices as 16 byte big-endian BLOBs.
+# Databases from before stored them hex-encoded, and indices in decimal, all as TEXT. For the seller database,
+# setup_databases.py --migrate converts old rows in batches while the services keep running, so until it is done,
+# reads must accept either format, and lookups by key must try both (see keys). The redeemer database is converted
+# by setup_databases.py --upgrade instead, since its table has to be rebuilt anyway (see bond_digest).
+INDEX_BYTES = 16
+
+def blob(value):
+	return sqlite3.Binary(value)
+
+def unblob(value):
+	if isinstance(value, buffer):
+		return str(value)
+	return value.decode("hex")
+
+def keys(value):
+	# The ways value may be stored, as parameters for "... in (?, ?)".
+	return (sqlite3.Binary(value), value.encode("hex"))
+
+def encode_index(index):
+	assert 0 <= index < 2**(8 * INDEX_BYTES)
+	return sqlite3.Binary(("%0*x" % (2 * INDEX_BYTES, index)).decode("hex"))
+
+def decode_index(value):
+	if isinstance(value, buffer):
+		return int(str(value).encode("hex"), 16)
+	return int(value)
+
+# Spent bonds are keyed by a 32 byte digest, rather than by the bonds themselves, which are kilobytes long.
+# A bond is base64 of the hex of a number, and the same number can be written in more than one way, so the digest
+# is of the number itself: otherwise a bond could be spent again just by writing it differently.
+def bond_digest(bond):
+	return sqlite3.Binary(hashlib.sha256("%x" % long(base64.b64decode(bond), 16)).digest())
@@ -1,24 +1,48 @@
 """
 dispenser: Dispenses bitcoins
 
-Iterates through unfulfilled rows of the RedeemerDB, marks them as fulfilled, and then sends BTC.
+Claims unfulfilled rows of the RedeemerDB, sends BTC for each, and then marks it as fulfilled.
 
 Requires:
 - Mix-out wallet private key (for sending bitcoins)
 - RedeemerDB RPC (to find where to send bitcoins)
 """
 
+import traceback
 import bitcoin
 from rpc_clients import RedeemerDB
 import global_storage
 
+# How many rows to claim at a time. Each cycle works through the whole backlog, one batch at a time.
+CLAIM_BATCH = 100
+
 def dispense():
-	for row in RedeemerDB.get_unfulfilled_rows():
-		# A row is a dict with keys 'bond', 'address', and 'fulfilled'.
-		assert row['fulfilled'] == 0 
+	while dispense_batch() == CLAIM_BATCH:
+		pass
+
+def dispense_batch():
+	# Returns how many rows were claimed.
+	# Claimed rows are never handed out again, so nothing is ever paid out twice.
+	rows = RedeemerDB.claim_unfulfilled(limit=CLAIM_BATCH)
+	sent = []
+	for row in rows:
+		# A row is a dict with keys 'bond', 'address', 'fulfilled' and 'state'.
+		assert row['fulfilled'] == 0
 		print "Unfulfilled row:", row
-		RedeemerDB.mark_fulfilled(bond=row['bond'])
-		send(global_storage.get_dispenser_private_key(), row['address'], global_storage.bond_value)
+		# One failed send mustn't stop the rest from going out.
+		try:
+			send(global_storage.get_dispenser_private_key(), row['address'], global_storage.bond_value)
+		except Exception:
+			# We can't tell whether anything went out, so the row stays claimed until someone looks into it.
+			print "Failed to send to %r, leaving its row in the dispensing state:" % row['address']
+			traceback.print_exc()
+			continue
+		sent.append(row['bond'])
+	# The rows stay claimed until then, so if we die before this, they are left dispensing, and never paid twice.
+	# Marking them all at once takes one round trip and one commit, rather than one of each per row.
+	if sent:
+		RedeemerDB.mark_fulfilled_many([{"bond": bond} for bond in sent])
+	return len(rows)
 
 def send(fromprivkey, toaddr, value):
 	transaction_fee = 20000 # .0002 BTC
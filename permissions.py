@@ -5,14 +5,14 @@ This program launches all the others.
 It also chmods everything in the jail to set the bits appropriately.
 """
 
-import os, sys, time, collections
+import os, sys, collections
 
 # This is a special user we promise will never have any privs for anything.
 NO_PRIVS = 999999
 
 # This is a global listing of all the processes we need to launch.
-# We keep track of the order to track dependencies.
-# We will launch processes in the order they are added to this dict.
+# We keep track of the order so that UIDs and GIDs are assigned the same way every time.
+# The launch order doesn't matter: RPC clients connect on first use, and wait for their server to come up.
 processes = collections.OrderedDict()
 
 # These are all the resources.
@@ -38,10 +38,42 @@ class Resource:
 		self.path = path
 		self.owner = owner
 
-def declare_rpc_service(name):
-	proc = Process(name, "/dryer21/code/rpc_lib.py", ["--launch", "rpc_servers." + name])
+# Services with workers > 1 run that many processes on the one socket, for CPU-bound work.
+# Don't use this for services that keep state in memory, like the databases, or caches: each worker would have
+# its own copy, and rpc_lib.py --stats only reports on whichever worker answers.
+# Services with engine="eventloop" serve all their connections from one event loop instead of a thread each.
+# That suits services that mostly wait on I/O, with handlers written as coroutines (see rpc_eventloop.py).
+# Services with an address listen on TCP there (e.g. "tcp:10.0.0.1:7001") instead of on their Unix socket,
+# and their clients are told to connect there. TCP connections are authenticated with the key in
+# data/rpc_key (see rpc_lib.py), which the service, and every process that calls it, is granted.
+def declare_rpc_service(name, workers=1, engine="threaded", address=None):
+	arguments = ["--launch", "rpc_servers." + name]
+	if workers > 1:
+		arguments += ["--workers", str(workers)]
+	if engine != "threaded":
+		arguments += ["--engine", engine]
+	if address is not None:
+		arguments += ["--address", address]
+		rpc_addresses[name] = address
+	proc = Process(name, "/dryer21/code/rpc_lib.py", arguments)
 	# Set the processes' RPC resource.
 	proc.rpc_resource = Resource("/dryer21/rpc/" + name, owner=name)
+	if address is not None:
+		proc.grant(rpc_key_resource())
+
+# The addresses of services that aren't on their usual Unix socket, which are passed to every process we launch.
+rpc_addresses = {}
+
+# Instead of declaring a service, this says that it runs on other hosts, launched there with
+#   rpc_lib.py --launch rpc_servers.<name> --address tcp:<host>:<port>
+# Calls to it are spread over the addresses, separated by commas, in turn.
+def declare_remote_rpc_service(name, addresses):
+	rpc_addresses[name] = addresses
+
+# The shared key that TCP connections are authenticated with, made on first use.
+RPC_KEY_PATH = "/dryer21/data/rpc_key"
+def rpc_key_resource():
+	return resources[RPC_KEY_PATH] if RPC_KEY_PATH in resources else Resource(RPC_KEY_PATH)
 
 # This function lets a given process have access to a given resource.
 def grant(name, path):
@@ -49,6 +81,13 @@ def grant(name, path):
 
 # This function lets caller have access to server's RPC socket.
 def grant_rpc(caller, server):
+	# Calls to a service on TCP need the key it authenticates them with.
+	if server in rpc_addresses and rpc_key_resource() not in processes[caller].access:
+		processes[caller].grant(rpc_key_resource())
+	# There's no socket to grant access to for remote services.
+	if server not in processes:
+		assert server in rpc_addresses
+		return
 	processes[caller].grant(processes[server].rpc_resource)
 
 # This function computes UIDs and GIDs for each process and resource.
@@ -114,31 +153,28 @@ def launch_sequence():
 			os.setgroups(process.groups)
 			os.setresuid(process.uid, process.uid, process.uid)
 			# Now launch python on the given script.
-			os.execve("/usr/bin/python", ["python", process.binary_path] + process.arguments, {"HOME": "/nonexistant", "PYTHONPATH": "/dryer21/code"})
+			environment = {"HOME": "/nonexistant", "PYTHONPATH": "/dryer21/code"}
+			for name, address in rpc_addresses.items():
+				environment["DRYER21_RPC_" + name] = address
+			os.execve("/usr/bin/python", ["python", process.binary_path] + process.arguments, environment)
 		else:
-			# Wait for the child to finish setting up, if it has an rpc_resource.
-			# This is necessary to prevent race conditions where future processes try to connect before this one is done setting up.
-			if process.rpc_resource != None:
-				# Currently I just use a little spin loop, which is good enough -- I'm not going to use inotify.
-				while not os.path.exists(process.rpc_resource.path + "/sock"):
-					time.sleep(0.1)
+			# No need to wait for the child to finish setting up: its clients retry until it does.
 			wait_list.append(pid)
 	for pid in wait_list:
 		os.waitpid(pid, 0)
 	print "Exiting."
 
-# Declare all the processes, which will be launched in the declared order.
-# NOTE: These MUST be declared in RPC dependency order!
+# Declare all the processes. They are all launched at once, so the order here doesn't matter.
 declare_rpc_service("SellerDB")
-declare_rpc_service("Sign")
-declare_rpc_service("Check")
-declare_rpc_service("IssueProtobond")
+declare_rpc_service("Sign", workers=4)
+declare_rpc_service("Check", engine="eventloop")
+declare_rpc_service("IssueProtobond", engine="eventloop")
 declare_rpc_service("GenQuote")
 Process("Seller", "/dryer21/code/seller/seller.py")
 Process("Collector", "/dryer21/code/collector.py")
 
 declare_rpc_service("RedeemerDB")
-declare_rpc_service("BondRedeemer")
+declare_rpc_service("BondRedeemer", workers=4)
 Process("Redeemer", "/dryer21/code/redeemer/redeemer.py")
 Process("Dispenser", "/dryer21/code/dispenser.py")
 
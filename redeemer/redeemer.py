@@ -17,6 +17,9 @@ app = Flask(__name__)
 # Restrict uploading files larger than 10kB.
 # Tokens are ~1kB, but this prevents cat GIF uploads.
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024
+# Give up on the RPCs behind a request after this many seconds, rather than letting requests pile up
+# behind a stalled service. Every service along the way gives up at the same time.
+REQUEST_TIMEOUT = 30
 
 @app.route('/')
 def index():
@@ -36,12 +39,18 @@ def redeem_bond():
 	if not to_addr:
 		return bond_error('No destination bitcoin address supplied!')
 	# We've confirmed that the user has properly supplied a bond and an address
-	BondRedeemer.bond_redeem(bond=bond, address=to_addr)
+	with rpc_lib.deadline(REQUEST_TIMEOUT):
+		BondRedeemer.bond_redeem(bond=bond, address=to_addr)
 	return render_template('bond_success.html', to_addr=to_addr)
 
 def bond_error(err_msg=None):
 	return render_template('bond_error.html', err_msg=err_msg)
 
+@app.errorhandler(rpc_lib.RPCTimeout)
+def rpc_lib_RPCTimeout(error):
+	print traceback.format_exc()
+	return bond_error('The server is too busy right now, please try again later.'), 503
+
 @app.errorhandler(rpc_lib.RPCException)
 def rpc_lib_RPCException(error):
 	print traceback.format_exc()
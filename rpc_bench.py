@@ -0,0 +1,326 @@
+#! /usr/bin/python
+"""
+rpc_bench.py
+
+A load generator for rpc_lib, for comparing protocol and server engine changes with numbers.
+It starts a server on a temporary Unix socket, exposing a stand-in handler with a configurable CPU cost,
+sleep and payload size, drives it from a number of client threads or processes, and reports the throughput
+and latency percentiles.
+
+Run it with --help for the options, or with --suite for a standard set of scenarios.
+"""
+
+import os, sys, json, time, shutil, signal, tempfile, threading, subprocess, multiprocessing
+
+import rpc_lib
+
+# Payloads shaped like the real ones: a token is about 1.4 KB, and the bulk database calls return lists of rows.
+# They are all text, like the hex strings the services pass around, since version 1 can only carry text.
+TOKEN_BYTES = 1400
+
+def random_text(length):
+	return os.urandom(length / 2).encode("hex")
+
+def make_payload(kind):
+	# kind is "none", "token", "bytes:<count>", or "rows:<count>".
+	if kind == "none":
+		return None
+	if kind == "token":
+		return random_text(TOKEN_BYTES)
+	name, count = kind.split(":")
+	count = int(count)
+	if name == "bytes":
+		return random_text(count)
+	if name == "rows":
+		return [{
+			"token": random_text(TOKEN_BYTES),
+			"address_index": str(2**127 + i),
+			"address": "1BenchBenchBenchBenchBenchBench%03i" % (i % 1000),
+			"price": 65000,
+			"timestamp": 1400000000.0 + i,
+			"protobond_sent": 1,
+		} for i in xrange(count)]
+	raise ValueError("Unknown payload: %r" % kind)
+
+# The stand-in handler. It is registered under the policy chosen for the server when it is launched.
+responses = {}
+def work(cpu, sleep, response, data=None):
+	# Burn cpu seconds of CPU time, then sleep, then return the requested payload.
+	if cpu:
+		end = time.clock() + cpu
+		while time.clock() < end:
+			pass
+	if sleep:
+		time.sleep(sleep)
+	if response not in responses:
+		responses[response] = make_payload(response)
+	return responses[response]
+
+def parse_policy(name):
+	if name == "serialized":
+		return rpc_lib.SERIALIZED
+	if name == "parallel":
+		return rpc_lib.PARALLEL
+	if name.startswith("bounded:"):
+		return rpc_lib.bounded(int(name[len("bounded:"):]))
+	raise ValueError("Unknown policy: %r" % name)
+
+def serve(socket_path, policy, engine, workers):
+	rpc_lib.set_rpc_socket_path(socket_path)
+	rpc_lib.expose_rpc(work, concurrency=parse_policy(policy))
+	if engine == "threaded":
+		server = rpc_lib.RPCServer(socket_path, rpc_lib.RPCRequestHandler)
+		server.daemon_threads = True
+	else:
+		import rpc_eventloop
+		server = rpc_eventloop.EventLoopServer(socket_path)
+	if workers == 1:
+		server.serve_forever()
+	children = [rpc_lib.spawn_worker(server) for i in xrange(workers)]
+	# Take the workers down with us.
+	def stop(signum, frame):
+		for pid in children:
+			os.kill(pid, signal.SIGTERM)
+		os._exit(0)
+	signal.signal(signal.SIGTERM, stop)
+	while True:
+		time.sleep(3600)
+
+def drive(socket_path, options, deadline, results):
+	# One client: make calls until the deadline, and append (start time, latency) for each to results.
+	client = rpc_lib.RPCClient(socket_path, max_protocol_version=options["protocol"], pool_size=options["pipeline"])
+	kwargs = {"cpu": options["cpu"], "sleep": options["sleep"], "response": options["response"]}
+	if options["request"] != "none":
+		kwargs["data"] = make_payload(options["request"])
+	if options["pipeline"] == 1:
+		# Pooled calls speak at most rpc_lib.SYNC_PROTOCOL_VERSION, so version 3 is only measured through call_async.
+		if options["api"] == "async":
+			call = lambda: client.call_async("work", kwargs).result()
+		else:
+			call = lambda: client.call("work", kwargs)
+		while time.time() < deadline:
+			start = time.time()
+			call()
+			results.append((start, time.time() - start))
+		return
+	# Keep pipeline calls outstanding at all times.
+	condition = threading.Condition()
+	state = {"outstanding": 0}
+	def finished(start):
+		def callback(future):
+			# This runs on the client's reader thread, so it mustn't raise.
+			with condition:
+				results.append((start, time.time() - start))
+				state["outstanding"] -= 1
+				condition.notify()
+		return callback
+	while time.time() < deadline:
+		with condition:
+			while state["outstanding"] >= options["pipeline"]:
+				condition.wait()
+			state["outstanding"] += 1
+		client.call_async("work", kwargs).add_done_callback(finished(time.time()))
+	with condition:
+		while state["outstanding"]:
+			condition.wait()
+
+def drive_process(socket_path, options, deadline, queue):
+	results = []
+	drive(socket_path, options, deadline, results)
+	queue.put(results)
+
+def percentile(latencies, fraction):
+	# latencies must be sorted.
+	return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+def run(options):
+	# Run one scenario, and return its report as a dict.
+	directory = tempfile.mkdtemp(prefix="rpc_bench")
+	socket_path = os.path.join(directory, "sock")
+	server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", socket_path,
+		options["policy"], options["engine"], str(options["workers"])])
+	try:
+		# Make sure the server is up before the clock starts.
+		rpc_lib.RPCClient(socket_path).call("work", {"cpu": 0, "sleep": 0, "response": "none"})
+		start = time.time()
+		deadline = start + options["warmup"] + options["duration"]
+		results = []
+		if options["mode"] == "thread":
+			threads = [threading.Thread(target=drive, args=(socket_path, options, deadline, results)) for i in xrange(options["clients"])]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		else:
+			queue = multiprocessing.Queue()
+			processes = [multiprocessing.Process(target=drive_process, args=(socket_path, options, deadline, queue)) for i in xrange(options["clients"])]
+			for process in processes:
+				process.start()
+			for process in processes:
+				results.extend(queue.get())
+			for process in processes:
+				process.join()
+	finally:
+		server.terminate()
+		server.wait()
+		shutil.rmtree(directory)
+	# Only count calls started after the warmup, and finished by the deadline.
+	measured_from = start + options["warmup"]
+	latencies = sorted(latency for started, latency in results if started >= measured_from and started + latency <= deadline)
+	if not latencies:
+		raise Exception("No calls finished in the measurement window.")
+	return {
+		"calls": len(latencies),
+		"throughput": len(latencies) / options["duration"],
+		"mean": sum(latencies) / len(latencies),
+		"p50": percentile(latencies, 0.5),
+		"p99": percentile(latencies, 0.99),
+		"p999": percentile(latencies, 0.999),
+		"max": latencies[-1],
+	}
+
+DEFAULTS = {
+	"protocol": rpc_lib.PROTOCOL_VERSION,
+	"engine": "threaded",
+	"policy": "serialized",
+	"workers": 1,
+	"clients": 8,
+	"mode": "thread",
+	"pipeline": 1,
+	"api": "sync",
+	"cpu": 0.0,
+	"sleep": 0.0,
+	"request": "token",
+	"response": "token",
+	"duration": 5.0,
+	"warmup": 1.0,
+}
+
+# The standard scenarios: every protocol with token-sized and row-list payloads, the cost of the global lock
+# with handlers that sleep, and the two engines. The version 3 ones go through call_async, as that is the only
+# way to get version 3 (see drive).
+SUITE = [
+	dict(name="v%i token" % version, protocol=version, api="async" if version >= 3 else "sync") for version in (1, 2, 3)
+] + [
+	dict(name="v%i 500 rows" % version, protocol=version, api="async" if version >= 3 else "sync", request="none", response="rows:500") for version in (1, 2, 3)
+] + [
+	dict(name="v3 1 MB", api="async", request="none", response="bytes:1048576"),
+	dict(name="sleep 5ms serialized", sleep=0.005),
+	dict(name="sleep 5ms parallel", sleep=0.005, policy="parallel"),
+	dict(name="sleep 5ms bounded:4", sleep=0.005, policy="bounded:4"),
+	dict(name="cpu 1ms serialized", cpu=0.001),
+	dict(name="cpu 1ms 4 workers", cpu=0.001, policy="parallel", workers=4, mode="process"),
+	dict(name="eventloop token", engine="eventloop"),
+	dict(name="eventloop pipelined", engine="eventloop", pipeline=16, clients=2),
+	dict(name="threaded pipelined", pipeline=16, clients=2, policy="parallel"),
+]
+
+# The messages for --codec: the requests and responses of common calls, as they go on the wire.
+def codec_messages():
+	token = make_payload("token")
+	row = {"address_index": 2**127 + 1, "address": "1BenchBenchBenchBenchBenchBench001", "price": 65000,
+		"timestamp": 1400000000.0, "protobond_sent": 0, "protobond": None, "paid": False}
+	return [
+		("token request", ["sign", {"token": token}, {"timeout": 5.0}]),
+		("token response", ["good", token]),
+		("check request", [1, "check", {"address": row["address"], "price": row["price"]}, {"timeout": 5.0}]),
+		("bool response", [1, "good", True]),
+		("row response", ["good", row]),
+		("500 rows response", ["good", make_payload("rows:500")]),
+	]
+
+def codec_time(encode, decode, message, seconds=0.5):
+	# The microseconds it takes to encode message and decode it again, at best.
+	data = encode(message)
+	best = None
+	for i in xrange(5):
+		count, start = 0, time.time()
+		while time.time() < start + seconds / 5:
+			decode(encode(message))
+			count += 1
+		elapsed = (time.time() - start) / count
+		best = elapsed if best is None else min(best, elapsed)
+	return best * 1e6, len(data)
+
+def codec_report():
+	# Compares the message encodings of version 1 and of versions 2 and 3, without any sockets in the way.
+	v1 = (lambda message: json.dumps(message).encode("hex"), lambda data: json.loads(data.decode("hex")))
+	v2 = (rpc_lib.encode_value, rpc_lib.decode_value)
+	print "%-24s %10s %10s %10s %10s" % ("message", "v1 us", "v2 us", "v1 bytes", "v2 bytes")
+	for name, message in codec_messages():
+		v1_time, v1_bytes = codec_time(v1[0], v1[1], message)
+		v2_time, v2_bytes = codec_time(v2[0], v2[1], message)
+		print "%-24s %10.1f %10.1f %10i %10i" % (name, v1_time, v2_time, v1_bytes, v2_bytes)
+
+def format_report(name, report):
+	return "%-24s %8i %10.1f %9.2f %9.2f %9.2f %9.2f %9.2f" % (name, report["calls"], report["throughput"],
+		report["mean"] * 1000, report["p50"] * 1000, report["p99"] * 1000, report["p999"] * 1000, report["max"] * 1000)
+
+REPORT_HEADER = "%-24s %8s %10s %9s %9s %9s %9s %9s" % ("scenario", "calls", "calls/s", "mean ms", "p50 ms", "p99 ms", "p999 ms", "max ms")
+
+def parse_options(arguments):
+	options = dict(DEFAULTS)
+	if len(arguments) % 2:
+		raise ValueError("Options must come in pairs.")
+	for flag, value in zip(arguments[0::2], arguments[1::2]):
+		key = flag.lstrip("-")
+		if not flag.startswith("--") or key not in DEFAULTS:
+			raise ValueError("Unknown option: %r" % flag)
+		options[key] = type(DEFAULTS[key])(value)
+	return options
+
+def usage():
+	print "Usage: rpc_bench.py [--<option> <value>]..."
+	print "       rpc_bench.py --suite [--<option> <value>]..."
+	print "       rpc_bench.py --codec"
+	print
+	print "Benchmarks an rpc_lib server running a stand-in handler, with these options:"
+	print "  --protocol N       highest protocol version the clients speak (1, 2 or 3)"
+	print "  --engine E         server engine: threaded or eventloop"
+	print "  --policy P         handler concurrency: serialized, parallel or bounded:<limit>"
+	print "  --workers N        server processes (prefork)"
+	print "  --clients N        client threads or processes"
+	print "  --mode M           thread or process clients"
+	print "  --pipeline N       calls each client keeps outstanding (more than 1 uses call_async)"
+	print "  --api A            with one call outstanding, sync (call, pooled, at most version %i) or async (call_async)" % rpc_lib.SYNC_PROTOCOL_VERSION
+	print "  --cpu S            CPU seconds burned per call"
+	print "  --sleep S          seconds slept per call"
+	print "  --request P        payload sent with each call"
+	print "  --response P       payload returned by each call"
+	print "  --duration S       seconds measured"
+	print "  --warmup S         seconds run before measuring"
+	print "Payloads are none, token (%i bytes), bytes:<count>, or rows:<count> (seller database rows)." % TOKEN_BYTES
+	print "The defaults are: %s" % " ".join("--%s %s" % item for item in sorted(DEFAULTS.items()))
+	print
+	print "With --suite, runs a standard set of scenarios, with the given options as the base for each."
+	print "With --codec, times just encoding and decoding some common messages with each protocol version."
+
+if __name__ == "__main__":
+	arguments = sys.argv[1:]
+	if len(arguments) == 5 and arguments[0] == "--serve":
+		serve(arguments[1], arguments[2], arguments[3], int(arguments[4]))
+		exit()
+	if "--help" in arguments:
+		usage()
+		exit()
+	if arguments == ["--codec"]:
+		codec_report()
+		exit()
+	suite = "--suite" in arguments
+	if suite:
+		arguments.remove("--suite")
+	try:
+		base = parse_options(arguments)
+	except ValueError, e:
+		print e
+		usage()
+		exit(1)
+	print REPORT_HEADER
+	if not suite:
+		print format_report("custom", run(base))
+		exit()
+	for scenario in SUITE:
+		options = dict(base)
+		options.update(scenario)
+		print format_report(options.pop("name"), run(options))
+		sys.stdout.flush()
@@ -6,4 +6,5 @@ import rpc_lib
 
 ctx = rpc_lib.RPCClient("rpc/Check/sock")
 check = ctx.make_stub("check")
+check_async = ctx.make_async_stub("check")
 
@@ -7,5 +7,9 @@ import rpc_lib
 ctx = rpc_lib.RPCClient("rpc/RedeemerDB/sock")
 try_to_redeem = ctx.make_stub("try_to_redeem")
 mark_fulfilled = ctx.make_stub("mark_fulfilled")
+mark_fulfilled_many = ctx.make_batch_stub("mark_fulfilled")
 get_unfulfilled_rows = ctx.make_stub("get_unfulfilled_rows")
+get_unfulfilled_rows_page = ctx.make_stub("get_unfulfilled_rows_page")
+iterate_unfulfilled_rows = ctx.make_page_iterator("get_unfulfilled_rows_page")
+claim_unfulfilled = ctx.make_stub("claim_unfulfilled")
 
@@ -6,7 +6,20 @@ import rpc_lib
 
 ctx = rpc_lib.RPCClient("rpc/SellerDB/sock")
 get = ctx.make_stub("get")
+get_async = ctx.make_async_stub("get")
 put = ctx.make_stub("put")
+get_or_create = ctx.make_stub("get_or_create")
 mark_protobond_sent = ctx.make_stub("mark_protobond_sent")
+mark_protobond_sent_async = ctx.make_async_stub("mark_protobond_sent")
 get_rows_with_protobond_sent = ctx.make_stub("get_rows_with_protobond_sent")
+get_rows_with_protobond_sent_page = ctx.make_stub("get_rows_with_protobond_sent_page")
+iterate_rows_with_protobond_sent = ctx.make_page_iterator("get_rows_with_protobond_sent_page")
+claim_pending_collection = ctx.make_stub("claim_pending_collection")
+mark_collected = ctx.make_stub("mark_collected")
+release_collection = ctx.make_stub("release_collection")
+get_expired_quotes_page = ctx.make_stub("get_expired_quotes_page")
+mark_paid = ctx.make_stub("mark_paid")
+mark_underpaid = ctx.make_stub("mark_underpaid")
+expire_quotes = ctx.make_stub("expire_quotes")
+archive_collected = ctx.make_stub("archive_collected")
 
@@ -2,3 +2,4 @@ import rpc_lib
 
 ctx = rpc_lib.RPCClient("rpc/Sign/sock")
 sign = ctx.make_stub("sign")
+sign_async = ctx.make_async_stub("sign")
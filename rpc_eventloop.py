@@ -0,0 +1,500 @@
+"""
+rpc_eventloop.py
+
+An alternative engine for rpc_lib servers. Instead of a thread per connection, one thread runs an event loop
+that serves every connection, speaking the same protocols on the same sockets as the threaded engine.
+
+Handlers that are coroutines (see rpc_lib.Return) are suspended whenever they yield an RPCFuture, and resumed
+on the loop once it is done, so a service that mostly waits on other services can have thousands of calls in
+flight without a thread each. Plain handlers run right on the loop, so they must not block: anything slow
+should go through rpc_lib.run_in_thread.
+
+Concurrency policies still apply, but are enforced by the loop: a serialized coroutine holds its slot from
+when it starts until it finishes, even while it is suspended.
+"""
+
+import os, sys, stat, json, time, errno, fcntl, heapq, select, socket, struct, threading, collections, traceback, types
+
+import rpc_lib
+
+class EventLoop:
+	def __init__(self):
+		self.poller = select.poll()
+		self.handlers = {}
+		self.ready = collections.deque()
+		self.ready_lock = threading.Lock()
+		# A heap of (when, sequence number, callback, args) for call_at.
+		self.timers = []
+		self.timer_sequence = 0
+		# Other threads wake us up by writing to this pipe.
+		self.wake_read, self.wake_write = os.pipe()
+		for fd in (self.wake_read, self.wake_write):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.poller.register(self.wake_read, select.POLLIN)
+		# The number of calls running under each concurrency policy, and the calls waiting to start.
+		self.policy_active = collections.defaultdict(int)
+		self.policy_waiting = collections.defaultdict(collections.deque)
+
+	def register(self, fd, handler, events):
+		self.handlers[fd] = handler
+		self.poller.register(fd, events)
+
+	def modify(self, fd, events):
+		self.poller.modify(fd, events)
+
+	def unregister(self, fd):
+		del self.handlers[fd]
+		self.poller.unregister(fd)
+
+	def call_soon(self, callback, *args):
+		# Only to be used from the loop's own thread.
+		self.ready.append((callback, args))
+
+	def call_at(self, when, callback, *args):
+		# Like call_soon, but not before time.time() reaches when.
+		self.timer_sequence += 1
+		heapq.heappush(self.timers, (when, self.timer_sequence, callback, args))
+
+	def call_soon_threadsafe(self, callback, *args):
+		with self.ready_lock:
+			self.ready.append((callback, args))
+		try:
+			os.write(self.wake_write, "x")
+		except OSError, e:
+			# A full pipe means a wake-up is already pending.
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def run_forever(self):
+		rpc_lib.event_loop_thread.active = True
+		while True:
+			if self.ready:
+				timeout = 0
+			elif self.timers:
+				timeout = max(int((self.timers[0][0] - time.time()) * 1000) + 1, 0)
+			else:
+				timeout = None
+			try:
+				events = self.poller.poll(timeout)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd, event in events:
+				if fd == self.wake_read:
+					try:
+						while os.read(self.wake_read, 4096):
+							pass
+					except OSError:
+						pass
+				elif fd in self.handlers:
+					self.handlers[fd].handle_event(event)
+			now = time.time()
+			while self.timers and self.timers[0][0] <= now:
+				when, sequence, callback, args = heapq.heappop(self.timers)
+				self.call_soon(callback, *args)
+			# Only run what is ready now; callbacks queued by these run on the next pass.
+			with self.ready_lock:
+				ready, self.ready = self.ready, collections.deque()
+			for callback, args in ready:
+				try:
+					callback(*args)
+				except Exception:
+					traceback.print_exc()
+
+	def acquire_policy(self, policy, start):
+		# Call start once policy lets another call run.
+		limit = rpc_lib.policy_limit(policy)
+		if limit is None or self.policy_active[policy] < limit:
+			self.policy_active[policy] += 1
+			start()
+		else:
+			self.policy_waiting[policy].append(start)
+
+	def release_policy(self, policy):
+		if self.policy_waiting[policy]:
+			# Hand our slot straight to the next call in line.
+			self.call_soon(self.policy_waiting[policy].popleft())
+		else:
+			self.policy_active[policy] -= 1
+
+# Drives a coroutine on the loop. done is called with ("good", result), or ("error", exc_info).
+# Many tasks share the loop's thread, so each one carries its own deadline, and makes it the current deadline
+# (see rpc_lib.deadline) only while it runs.
+class Task:
+	def __init__(self, loop, generator, done, deadline=None):
+		self.loop, self.generator, self.done, self.deadline = loop, generator, done, deadline
+		self.waiting = None
+		self.step(None, None)
+
+	def step(self, send_value, error):
+		rpc_lib.call_context.deadline = self.deadline
+		try:
+			if error is not None:
+				yielded = self.generator.throw(*error)
+			else:
+				yielded = self.generator.send(send_value)
+		except StopIteration:
+			return self.done("good", None)
+		except rpc_lib.Return, r:
+			return self.done("good", r.value)
+		except Exception:
+			return self.done("error", sys.exc_info())
+		finally:
+			rpc_lib.call_context.deadline = None
+		if isinstance(yielded, types.GeneratorType):
+			Task(self.loop, yielded, self.resume_from_task, self.deadline)
+		elif isinstance(yielded, rpc_lib.RPCFuture):
+			# Futures are completed on other threads, so hop back onto the loop before resuming.
+			self.waiting = yielded
+			yielded.add_done_callback(lambda future: self.loop.call_soon_threadsafe(self.resume_from_future, future))
+			# If the future's deadline passes first, resume anyway, so that the coroutine gets an RPCTimeout.
+			if yielded.deadline is not None:
+				self.loop.call_at(yielded.deadline, self.resume_from_future, yielded)
+		else:
+			try:
+				raise TypeError("Coroutines must yield RPCFutures or coroutines, not %r." % (yielded,))
+			except TypeError:
+				self.loop.call_soon(self.step, None, sys.exc_info())
+
+	def resume_from_future(self, future):
+		# Whichever of the future and its deadline comes second finds we've moved on.
+		if future is not self.waiting:
+			return
+		self.waiting = None
+		try:
+			value = future.result(0)
+		except Exception:
+			return self.step(None, sys.exc_info())
+		self.step(value, None)
+
+	def resume_from_task(self, status, value):
+		if status == "good":
+			self.step(value, None)
+		else:
+			self.step(None, value)
+
+# Lets a connection reuse rpc_lib's protocol classes to encode its responses into the output buffer.
+class _OutputBuffer:
+	def __init__(self, connection):
+		self.connection = connection
+
+	def write(self, data):
+		self.connection.send(data)
+
+	def flush(self):
+		pass
+
+class Connection:
+	def __init__(self, loop, sock, authenticate=False):
+		self.loop, self.sock = loop, sock
+		self.fd = sock.fileno()
+		self.inbuf = bytearray()
+		self.outbuf = collections.deque()
+		self.protocol = None
+		# For versions 1 and 2, requests are answered strictly in order, so we run one at a time.
+		self.queue = collections.deque()
+		self.busy = False
+		self.in_flight = 0
+		# We stop reading when the client hangs up, or while it has too many calls in flight.
+		self.eof = self.paused = False
+		self.closed = False
+		self.loop.register(self.fd, self, select.POLLIN)
+		rpc_lib.logger.debug("[%s] Opening a connection.", rpc_lib.global_socket_path)
+		# For TCP, the client must authenticate before we parse anything else (see rpc_lib.auth_challenge).
+		# After that, what we receive goes into sealed until whole records of it can be checked and added to inbuf.
+		self.server_nonce = None
+		self.sealed = bytearray()
+		self.sealer = self.opener = None
+		if authenticate:
+			self.server_nonce, challenge = rpc_lib.auth_challenge()
+			self.send(challenge)
+			self.loop.call_at(time.time() + rpc_lib.AUTH_TIMEOUT, self.authentication_expired)
+
+	def authentication_expired(self):
+		if self.server_nonce is not None and not self.closed:
+			rpc_lib.logger.warning("[%s] Hanging up on a TCP client that didn't authenticate in time.", rpc_lib.global_socket_path)
+			self.close()
+
+	def update_events(self):
+		if self.closed:
+			return
+		reading = not self.eof and not self.paused
+		events = (select.POLLIN if reading else 0) | (select.POLLOUT if self.outbuf else 0)
+		self.loop.modify(self.fd, events)
+
+	def handle_event(self, event):
+		if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+			self.handle_read(event)
+		if not self.closed and event & select.POLLOUT:
+			self.handle_write()
+
+	def handle_read(self, event):
+		try:
+			data = self.sock.recv(65536)
+		except socket.error, e:
+			if e.args[0] in (errno.EAGAIN, errno.EINTR):
+				return
+			return self.close()
+		if not data:
+			self.eof = True
+			if event & (select.POLLHUP | select.POLLERR):
+				# The client is gone entirely, so there's nobody to answer.
+				return self.close()
+			# The client is done sending. Once any calls still running are answered, we're done too.
+			self.maybe_finish()
+			return self.update_events()
+		try:
+			if self.opener is not None:
+				self.sealed += data
+				self.unseal()
+			else:
+				self.inbuf += data
+			self.parse()
+		except rpc_lib.AuthenticationError, e:
+			rpc_lib.logger.warning("[%s] Hanging up: %s", rpc_lib.global_socket_path, e)
+			self.close()
+		except Exception:
+			# Just like an exception in a threaded handler, this kills the connection.
+			traceback.print_exc()
+			self.close()
+
+	def parse(self):
+		while not self.closed:
+			if self.server_nonce is not None:
+				line = self.take_line(rpc_lib.MAX_AUTH_LINE)
+				if line is None:
+					return
+				answer, keys = rpc_lib.check_client_auth(self.server_nonce, line)
+				self.send(answer)
+				self.server_nonce = None
+				client_key, server_key = keys
+				self.sealer, self.opener = rpc_lib.RecordMAC(server_key), rpc_lib.RecordMAC(client_key)
+				# Anything after the client's answer is already sealed.
+				self.sealed += self.inbuf
+				del self.inbuf[:]
+				self.unseal()
+			elif self.protocol is None:
+				line = self.take_line()
+				if line is None:
+					return
+				if line.startswith(rpc_lib.HANDSHAKE_PREFIX):
+					version = min(int(line[len(rpc_lib.HANDSHAKE_PREFIX):]), rpc_lib.PROTOCOL_VERSION)
+					if version not in rpc_lib.protocols:
+						raise rpc_lib.ProtocolError("Unsupported protocol version: %r" % version)
+					self.send("%s%i\n" % (rpc_lib.HANDSHAKE_PREFIX, version))
+					self.protocol = rpc_lib.protocols[version](None, _OutputBuffer(self))
+				else:
+					self.protocol = rpc_lib.HexJSONProtocol(None, _OutputBuffer(self))
+					self.inbuf[0:0] = line
+			elif self.protocol.version == 1:
+				line = self.take_line()
+				if line is None:
+					return
+				self.request(None, *json.loads(line.strip().decode("hex")))
+			else:
+				if self.protocol.version >= 3 and self.in_flight >= rpc_lib.MAX_IN_FLIGHT_PER_CONNECTION:
+					# Stop reading until some of the calls we are running finish.
+					self.paused = True
+					return self.update_events()
+				if len(self.inbuf) < 4:
+					return
+				length, = struct.unpack(">I", str(self.inbuf[:4]))
+				if length > rpc_lib.MAX_FRAME_LEN:
+					raise rpc_lib.ProtocolError("Frame of %i bytes is too large." % length)
+				if len(self.inbuf) < 4 + length:
+					return
+				message = rpc_lib.decode_value(str(self.inbuf[4:4 + length]))
+				del self.inbuf[:4 + length]
+				if self.protocol.version >= 3:
+					self.request(*message)
+				else:
+					self.request(None, *message)
+
+	def unseal(self):
+		# Move the payloads of the whole records in sealed to inbuf (see rpc_lib.SealedFile).
+		while len(self.sealed) >= 4:
+			length, = struct.unpack(">I", str(self.sealed[:4]))
+			if length > rpc_lib.MAX_RECORD_LEN:
+				raise rpc_lib.ProtocolError("Record of %i bytes is too large." % length)
+			end = 4 + length + rpc_lib.RECORD_MAC_LEN
+			if len(self.sealed) < end:
+				return
+			self.inbuf += self.opener.open(str(self.sealed[:4]), str(self.sealed[4:4 + length]), str(self.sealed[4 + length:end]))
+			del self.sealed[:end]
+
+	def take_line(self, limit=rpc_lib.MAX_FRAME_LEN):
+		end = self.inbuf.find("\n")
+		if end < 0:
+			if len(self.inbuf) > limit:
+				raise rpc_lib.ProtocolError("Line too long.")
+			return None
+		line = str(self.inbuf[:end + 1])
+		del self.inbuf[:end + 1]
+		return line
+
+	def request(self, request_id, method, kwargs, options=None):
+		# Deadlines count from when the request arrived, even if it then waits in the queue.
+		deadline = rpc_lib.request_deadline(options, time.time())
+		if self.protocol.version >= 3:
+			self.start(request_id, method, kwargs, deadline)
+		else:
+			self.queue.append((request_id, method, kwargs, deadline))
+			self.pump()
+
+	def pump(self):
+		if not self.busy and self.queue:
+			self.busy = True
+			self.start(*self.queue.popleft())
+
+	def start(self, request_id, method, kwargs, deadline):
+		self.in_flight += 1
+		try:
+			function, policy = rpc_lib.lookup_method(method, kwargs)
+			stats = rpc_lib.method_stats(method, kwargs)
+		except Exception:
+			# E.g. an unknown method. There's no policy to release or stats to keep, just the failure to report.
+			return self.fail(request_id, sys.exc_info())
+		stats.begin()
+		times = [time.time()]
+		def run():
+			times.append(time.time())
+			# Whatever waiting the call did may have used up the rest of the caller's time.
+			if rpc_lib.expired(deadline):
+				return finish("timeout", "Deadline expired while %s waited to run." % method)
+			rpc_lib.call_context.deadline = deadline
+			try:
+				return_value = function(**kwargs)
+			except rpc_lib.RPCException, e:
+				return finish(rpc_lib.response_status(e), e.message)
+			except Exception:
+				return finish("error", sys.exc_info())
+			finally:
+				rpc_lib.call_context.deadline = None
+			if isinstance(return_value, types.GeneratorType):
+				Task(self.loop, return_value, finish, deadline)
+			else:
+				finish("good", return_value)
+		def finish(status, value):
+			self.loop.release_policy(policy)
+			if status == "error" and isinstance(value[1], rpc_lib.RPCException):
+				status, value = rpc_lib.response_status(value[1]), value[1].message
+			latency = time.time() - times[0]
+			stats.end(latency, times[1] - times[0], status)
+			rpc_lib.log_call(method, kwargs, status, latency)
+			if status == "error":
+				return self.fail(request_id, value)
+			self.respond(request_id, status, value)
+		self.loop.acquire_policy(policy, run)
+
+	def fail(self, request_id, exc_info):
+		# For a call that failed with something other than an RPCException.
+		traceback.print_exception(*exc_info)
+		if self.protocol.version >= 3:
+			# Other calls may be running on this connection, so only this one is answered with the failure.
+			return self.respond(request_id, "error", repr(exc_info[1]))
+		# Versions 1 and 2 have no way to report it, so, just as in a threaded handler, this kills the connection.
+		self.close()
+
+	def respond(self, request_id, status, result):
+		self.in_flight -= 1
+		if self.closed:
+			return
+		if self.protocol.version >= 3:
+			self.protocol.write_message([request_id, status, result])
+			if self.paused:
+				self.paused = False
+				self.loop.call_soon(self.resume_parsing)
+		else:
+			self.protocol.write_message([status, result])
+			self.busy = False
+			self.loop.call_soon(self.pump)
+		self.maybe_finish()
+
+	def resume_parsing(self):
+		if self.closed:
+			return
+		try:
+			self.parse()
+		except Exception:
+			traceback.print_exc()
+			self.close()
+		self.update_events()
+
+	def send(self, data):
+		if self.sealer is not None:
+			data = self.sealer.seal(data)
+		self.outbuf.append(data)
+		self.handle_write()
+
+	def handle_write(self):
+		while self.outbuf and not self.closed:
+			data = self.outbuf[0]
+			try:
+				sent = self.sock.send(data)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EINTR):
+					break
+				return self.close()
+			if sent < len(data):
+				self.outbuf[0] = data[sent:]
+				break
+			self.outbuf.popleft()
+		self.update_events()
+		self.maybe_finish()
+
+	def maybe_finish(self):
+		# Close once the client has hung up and we have nothing left to tell it.
+		if not self.closed and self.eof and not self.outbuf and self.in_flight == 0 and not self.queue and not self.busy:
+			self.close()
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.loop.unregister(self.fd)
+		self.sock.close()
+
+class Listener:
+	def __init__(self, loop, sock, tcp):
+		self.loop, self.sock, self.tcp = loop, sock, tcp
+		self.loop.register(sock.fileno(), self, select.POLLIN)
+
+	def handle_event(self, event):
+		try:
+			sock, address = self.sock.accept()
+		except socket.error, e:
+			# With prefork workers, another process may have taken the connection first.
+			if e.args[0] in (errno.EAGAIN, errno.EINTR):
+				return
+			raise
+		sock.setblocking(0)
+		if self.tcp:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		Connection(self.loop, sock, authenticate=self.tcp)
+
+# The event loop counterpart of rpc_lib.RPCServer and rpc_lib.RPCTCPServer, for any address rpc_lib accepts.
+class EventLoopServer:
+	def __init__(self, server_address):
+		transport, location = rpc_lib.parse_address(server_address)
+		self.tcp = transport == "tcp"
+		if self.tcp:
+			# Fail now if we have no key to check clients with, as RPCTCPServer does.
+			rpc_lib.rpc_key()
+			family = socket.getaddrinfo(location[0], location[1], 0, socket.SOCK_STREAM)[0][0]
+			self.sock = socket.socket(family, socket.SOCK_STREAM)
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		else:
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.bind(location)
+		self.sock.listen(128)
+		self.sock.setblocking(0)
+		if not self.tcp:
+			# Set the permissions on our socket to +777, just like RPCServer does.
+			os.chmod(location, stat.S_IRWXO|stat.S_IRWXG|stat.S_IRWXU)
+
+	def serve_forever(self):
+		# The loop is made here rather than in __init__, so that each prefork worker gets its own.
+		loop = EventLoop()
+		Listener(loop, self.sock, self.tcp)
+		loop.run_forever()
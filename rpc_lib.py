@@ -2,26 +2,807 @@
 rpc_lib.py
 """
 
-import os, sys, stat, json, socket, functools, threading
-import SocketServer
+import os, sys, stat, json, errno, select, socket, struct, functools, threading, time, traceback, types
+import hmac, hashlib
+import logging, logging.handlers
+import Queue, SocketServer
 
 # These two functions are the API used for declaring an RPC server.
 def set_rpc_socket_path(socket_path):
 	global global_socket_path
 	global_socket_path = socket_path
 
+# Although RPC servers are multithreaded to handle multiple clients, by default this lock is used to make sure
+# that only one handler is actually calling a registered RPC callback at any time.
+global_rpc_server_lock = threading.Lock()
+
+# Concurrency policies, which can be given to expose_rpc per method.
+# A policy is anything usable in a with statement; the handler holds it for the duration of each call.
+class _Unlocked:
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *args):
+		pass
+
+# Share the global lock with every other serialized method in the service. This is the default.
+SERIALIZED = global_rpc_server_lock
+# No locking at all. Only use this for handlers that are safe to run on many threads at once.
+PARALLEL = _Unlocked()
+# At most limit calls to this method at once, independently of the global lock.
+class bounded:
+	def __init__(self, limit):
+		self.limit = limit
+		self.semaphore = threading.BoundedSemaphore(limit)
+
+	def __enter__(self):
+		self.semaphore.acquire()
+
+	def __exit__(self, *args):
+		self.semaphore.release()
+
+def policy_limit(policy):
+	# How many calls a policy lets run at once, or None for no limit.
+	if policy is PARALLEL:
+		return None
+	return getattr(policy, "limit", 1)
+
 global_rpc_table = {}
-def expose_rpc(function):
+global_rpc_policies = {}
+def expose_rpc(function=None, concurrency=SERIALIZED):
+	# This works both as a bare decorator, and as @expose_rpc(concurrency=...).
+	if function is None:
+		return lambda function: expose_rpc(function, concurrency=concurrency)
 	global_rpc_table[function.func_name] = function
+	global_rpc_policies[function.func_name] = concurrency
+	return function
+
+# Optionally, a method can also have a batch hook, which gets the keyword arguments of a whole batch of calls
+# (see RPCClient.call_many) as a list, so it can do them all in one go, e.g. in one database transaction.
+# It must return a list with one result per call. An RPCException instance in that list fails just that call,
+# while raising RPCException fails the whole batch. Without a hook, the calls in a batch are made one by one,
+# but still under a single acquisition of the method's concurrency policy.
+global_rpc_batch_handlers = {}
+def expose_rpc_batch(exposed_function):
+	def decorator(function):
+		global_rpc_batch_handlers[exposed_function.func_name] = function
+		return function
+	return decorator
+
+# Bulk queries are paginated with a keyset cursor, so that neither side ever has to hold a whole table.
+# A paginated method takes after, the cursor from the previous page (None for the first page), and limit,
+# and returns make_page(rows, limit, cursor), where cursor is a key that comes after every row on the page.
+# Clients go through all the rows with iterate_pages, or a stub from RPCClient.make_page_iterator.
+MAX_PAGE_SIZE = 1000
+
+def page_size(limit):
+	# The number of rows to actually return for a requested limit.
+	return max(1, min(limit, MAX_PAGE_SIZE))
+
+def make_page(rows, limit, cursor):
+	# A short page means there are no rows left, so there's no next cursor.
+	return {"rows": rows, "next": cursor if len(rows) >= limit else None}
+
+def iterate_pages(page_stub, **kwargs):
+	# Yields every row of a paginated method, fetching one page at a time.
+	after = None
+	while True:
+		page = page_stub(after=after, **kwargs)
+		for row in page["rows"]:
+			yield row
+		after = page["next"]
+		if after is None:
+			return
+
+# Batches travel as an ordinary call to this reserved method, so they work with every protocol version.
+BATCH_METHOD = "rpc.batch"
+# Calling this reserved method returns the server's metrics (see report_stats).
+STATS_METHOD = "rpc.stats"
+
+# Per-call logging goes through this logger at DEBUG level, which is off unless the server is launched with
+# --log-level DEBUG. Records are buffered and written out in bulk, rather than printed while a handler holds
+# its lock. Anything at WARNING or above is written out immediately.
+logger = logging.getLogger("rpc_lib")
+LOG_FLUSH_INTERVAL = 1.0
+
+def configure_logging(level="INFO"):
+	stream_handler = logging.StreamHandler(sys.stdout)
+	stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+	logger.addHandler(BufferedLogHandler(1000, flushLevel=logging.WARNING, target=stream_handler))
+	logger.setLevel(getattr(logging, level.upper()))
+
+class BufferedLogHandler(logging.handlers.MemoryHandler):
+	# A MemoryHandler with a thread that flushes it every LOG_FLUSH_INTERVAL, so that quiet periods don't leave
+	# records sitting in the buffer. The thread is started on first use, like db_lib.GroupCommit's, so that each
+	# forked worker (see spawn_worker) gets its own.
+	flusher = None
+
+	def emit(self, record):
+		# This is called with the handler's lock held.
+		if self.flusher is None or not self.flusher.is_alive():
+			self.flusher = threading.Thread(target=self.flush_periodically)
+			self.flusher.daemon = True
+			self.flusher.start()
+		logging.handlers.MemoryHandler.emit(self, record)
+
+	def flush_periodically(self):
+		while True:
+			time.sleep(LOG_FLUSH_INTERVAL)
+			self.flush()
+
+def summarize(value, limit=64):
+	# A short repr for logs, so that we don't write out whole tokens and bonds.
+	text = repr(value)
+	if len(text) <= limit:
+		return text
+	return "%s...<%i chars>" % (text[:limit], len(text))
+
+def log_call(method, kwargs, status, latency):
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug("[%s] %s(%s) -> %s in %.1fms", global_socket_path, method, summarize(kwargs), status, latency * 1000)
+
+# Metrics for every method, as reported by the STATS_METHOD call.
+# Latencies are measured from when a request is read to when its result is ready, so they include lock waits.
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+start_time = time.time()
+
+class MethodStats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = self.errors = self.timeouts = self.in_flight = 0
+		self.total_latency = self.max_latency = 0.0
+		self.total_lock_wait = self.max_lock_wait = 0.0
+		# One count per bucket in LATENCY_BUCKETS, plus one for anything slower.
+		self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+	def begin(self):
+		with self.lock:
+			self.in_flight += 1
+
+	def end(self, latency, lock_wait, status):
+		bucket = 0
+		while bucket < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[bucket]:
+			bucket += 1
+		with self.lock:
+			self.in_flight -= 1
+			self.calls += 1
+			if status != "good":
+				self.errors += 1
+			if status == "timeout":
+				self.timeouts += 1
+			self.total_latency += latency
+			self.max_latency = max(self.max_latency, latency)
+			self.total_lock_wait += lock_wait
+			self.max_lock_wait = max(self.max_lock_wait, lock_wait)
+			self.histogram[bucket] += 1
+
+	def snapshot(self):
+		with self.lock:
+			return {
+				"calls": self.calls,
+				"errors": self.errors,
+				"timeouts": self.timeouts,
+				"in_flight": self.in_flight,
+				"total_latency": self.total_latency,
+				"max_latency": self.max_latency,
+				"total_lock_wait": self.total_lock_wait,
+				"max_lock_wait": self.max_lock_wait,
+				# Pairs of (upper bound in seconds, count), where the last bound is None for infinity.
+				"latency_histogram": zip(LATENCY_BUCKETS + [None], self.histogram),
+			}
+
+global_rpc_stats = {}
+global_rpc_stats_lock = threading.Lock()
+def method_stats(method, kwargs):
+	# Batches are counted separately from single calls to the same method.
+	name = method if method != BATCH_METHOD else "%s[batch]" % kwargs["method"]
+	with global_rpc_stats_lock:
+		if name not in global_rpc_stats:
+			global_rpc_stats[name] = MethodStats()
+		return global_rpc_stats[name]
+
+# Services can add figures of their own to the report, e.g. for a cache: register_stats(name, function)
+# puts what function() returns at the time of each report under name, in the report's "extra" dict.
+global_extra_stats = {}
+def register_stats(name, function):
+	global_extra_stats[name] = function
+
+def report_stats():
+	# The handler for STATS_METHOD. With prefork workers, this only covers the worker that answers.
+	with global_rpc_stats_lock:
+		methods = dict(global_rpc_stats)
+	return {
+		"socket_path": global_socket_path,
+		"pid": os.getpid(),
+		"uptime": time.time() - start_time,
+		"methods": dict((name, stats.snapshot()) for name, stats in methods.items()),
+		"clients": dict((client.socket_path, client.stats()) for client in global_rpc_clients),
+		"extra": dict((name, function()) for name, function in global_extra_stats.items()),
+	}
 
 # This exception is transparently passed across the RPC boundary.
 # Raise it in your handlers to signal callers.
 class RPCException(Exception):
 	pass
 
-# Although RPC servers are multithreaded to handle multiple clients, this lock is used to make sure
-# that only one handler is actually calling a registered RPC callback at any time.
-global_rpc_server_lock = threading.Lock()
+# Raised when a call's deadline passes before it finishes, whether that is noticed by the client or by a server
+# along the way. It travels with its own "timeout" status, so callers can tell it apart from other failures.
+class RPCTimeout(RPCException):
+	pass
+
+# Raised by a client when the handler for its call failed with some other exception, e.g. a bug in it.
+# Only version 3 servers report that, with an "error" status; older versions just hang up.
+class RPCServerError(Exception):
+	pass
+
+# Deadlines, as absolute time.time() values.
+# Each thread has a current deadline, which every RPC it makes is bounded by and sends along to the server.
+# While a handler runs, the current deadline is that of the call it is serving, so the calls it makes in turn
+# inherit it, and a whole chain of calls gives up together instead of leaving work piled up downstream.
+call_context = threading.local()
+
+def current_deadline():
+	return getattr(call_context, "deadline", None)
+
+def earliest(*deadlines):
+	deadlines = [d for d in deadlines if d is not None]
+	return min(deadlines) if deadlines else None
+
+class deadline:
+	# with rpc_lib.deadline(seconds): bounds every RPC made in the block, including the ones they make downstream.
+	# It can only tighten an existing deadline, never extend it.
+	def __init__(self, seconds):
+		self.seconds = seconds
+
+	def __enter__(self):
+		self.saved = current_deadline()
+		call_context.deadline = earliest(self.saved, time.time() + self.seconds)
+
+	def __exit__(self, *args):
+		call_context.deadline = self.saved
+
+# Handlers can also be coroutines: generators that yield an RPCFuture (e.g. from an async stub, or run_in_thread)
+# whenever they need to wait, and get the result sent back in (or its exception raised) once it is ready.
+# They can also yield another coroutine, to run it to completion, and finish with raise Return(value).
+# The threaded engine simply blocks on each yielded future, while the event loop engine (see rpc_eventloop.py)
+# goes on serving other calls in the meantime.
+class Return(Exception):
+	def __init__(self, value=None):
+		Exception.__init__(self)
+		self.value = value
+
+def run_coroutine(generator):
+	# Run a coroutine to completion on this thread, and return its result.
+	send_value, error = None, None
+	while True:
+		try:
+			if error is not None:
+				yielded = generator.throw(*error)
+			else:
+				yielded = generator.send(send_value)
+		except StopIteration:
+			return None
+		except Return, r:
+			return r.value
+		send_value, error = None, None
+		try:
+			if isinstance(yielded, types.GeneratorType):
+				send_value = run_coroutine(yielded)
+			else:
+				send_value = yielded.result()
+		except Exception:
+			error = sys.exc_info()
+
+# Set on the thread running an event loop, which must never block.
+event_loop_thread = threading.local()
+
+# Threads for run_in_thread, started as needed.
+# A thread still running a function past its deadline has been given up on by whoever was waiting, and may never
+# come back, so it doesn't count towards the size: another one is started in its place. Once it does come back,
+# the pool is bigger than it should be, and it goes away.
+BLOCKING_POOL_SIZE = 16
+blocking_queue = Queue.Queue()
+blocking_threads = []
+blocking_threads_lock = threading.Lock()
+# The deadline of the function each busy thread is running, which may be None.
+blocking_deadlines = {}
+
+def blocking_worker():
+	me = threading.current_thread()
+	while True:
+		run, deadline = blocking_queue.get()
+		with blocking_threads_lock:
+			blocking_deadlines[me] = deadline
+		run()
+		with blocking_threads_lock:
+			del blocking_deadlines[me]
+			if len(blocking_threads) - abandoned_threads() > BLOCKING_POOL_SIZE:
+				blocking_threads.remove(me)
+				return
+
+def abandoned_threads():
+	# How many threads are running a function past its deadline. Call with blocking_threads_lock held.
+	now = time.time()
+	return len([deadline for deadline in blocking_deadlines.values() if deadline is not None and deadline < now])
+
+def run_in_thread(function, *args, **kwargs):
+	# Returns an RPCFuture for function(*args, **kwargs). For use by coroutines that have blocking work to do.
+	# On an event loop the function runs on a small pool of threads, so the loop isn't held up.
+	# Anywhere else it is just called right away, unless there is a deadline: then it goes to the pool as well,
+	# so that waiting on the future can give up at the deadline even if the function never returns.
+	deadline = current_deadline()
+	future = RPCFuture(deadline)
+	def run():
+		# Don't start work that whoever is waiting for has already given up on.
+		if expired(deadline):
+			return future.set_result("timeout", "Deadline expired before %s started." % getattr(function, "__name__", "the function"))
+		call_context.deadline = deadline
+		try:
+			future.set_result("good", function(*args, **kwargs))
+		except RPCTimeout, e:
+			future.set_result("timeout", e.message)
+		except RPCException, e:
+			future.set_result("bad", e.message)
+		except Exception, e:
+			future.set_result("failed", e)
+		finally:
+			call_context.deadline = None
+	if deadline is None and not getattr(event_loop_thread, "active", False):
+		run()
+		return future
+	with blocking_threads_lock:
+		if len(blocking_threads) - abandoned_threads() < BLOCKING_POOL_SIZE:
+			thread = threading.Thread(target=blocking_worker)
+			thread.daemon = True
+			thread.start()
+			blocking_threads.append(thread)
+	blocking_queue.put((run, deadline))
+	return future
+
+def lookup_method(method, kwargs):
+	# Returns the function to call for a request, and the concurrency policy to hold while calling it.
+	if method == BATCH_METHOD:
+		return run_batch, global_rpc_policies[kwargs["method"]]
+	if method == STATS_METHOD:
+		return report_stats, PARALLEL
+	return global_rpc_table[method], global_rpc_policies[method]
+
+def run_batch(method, calls):
+	# The handler for BATCH_METHOD. This is a coroutine, so that batches of calls to coroutines work too.
+	function = global_rpc_table[method]
+	if method in global_rpc_batch_handlers:
+		try:
+			results = global_rpc_batch_handlers[method](calls)
+			if isinstance(results, types.GeneratorType):
+				results = yield results
+		except RPCException, e:
+			results = [e] * len(calls)
+		assert len(results) == len(calls), "Batch hook for %r returned the wrong number of results!" % method
+	else:
+		results = []
+		for call_kwargs in calls:
+			try:
+				result = function(**call_kwargs)
+				if isinstance(result, types.GeneratorType):
+					result = yield result
+				results.append(result)
+			except RPCException, e:
+				results.append(e)
+	# Each result is reported the same way a single call's would be.
+	raise Return([(response_status(result), result.message) if isinstance(result, RPCException) else ("good", result) for result in results])
+
+def response_status(exception):
+	# The status to report an RPCException raised by a handler with.
+	return "timeout" if isinstance(exception, RPCTimeout) else "bad"
+
+def expired(deadline):
+	return deadline is not None and time.time() >= deadline
+
+# Wire protocols.
+# Version 1 is the original protocol: each message is a JSON array, hex-encoded, on its own line.
+# Version 2 sends each message as a length-prefixed binary frame, with byte strings carried raw.
+# Version 3 uses the same frames, but tags every request with an ID that is echoed in its response.
+# The server runs the requests on a connection concurrently, and answers them in whatever order they finish,
+# so a client can have many calls outstanding on one connection.
+# A client that wants version 2 or later opens the connection with a single handshake line:
+#   DRYER21-RPC <highest version the client speaks>\n
+# and the server answers with the same kind of line naming the version it picked.
+# A version 1 line only ever contains hex digits, so the server can tell the two apart from the first line,
+# and old clients that never send the handshake keep working unchanged.
+# In versions 2 and 3, a request may end with an extra dict of options. The only option so far is "timeout":
+# the seconds the client will wait for the call, which the server turns into a deadline of its own.
+PROTOCOL_VERSION = 3
+HANDSHAKE_PREFIX = "DRYER21-RPC "
+# Refuse to buffer absurd frames; the largest legitimate message is a list of database rows.
+MAX_FRAME_LEN = 64 * 1024 * 1024
+# The most requests the server will run at once for a single version 3 connection.
+# Past this, it stops reading from the connection until some finish.
+MAX_IN_FLIGHT_PER_CONNECTION = 64
+
+class ProtocolError(Exception):
+	pass
+
+class HexJSONProtocol:
+	version = 1
+
+	def __init__(self, rfile, wfile):
+		self.rfile, self.wfile = rfile, wfile
+
+	def read_message(self, first_line=None):
+		line = first_line if first_line is not None else self.rfile.readline()
+		if not line:
+			raise EOFError
+		return json.loads(line.strip().decode("hex"))
+
+	def write_message(self, message):
+		self.wfile.write(json.dumps(message).encode("hex") + "\n")
+		self.wfile.flush()
+
+class BinaryProtocol:
+	version = 2
+
+	def __init__(self, rfile, wfile):
+		self.rfile, self.wfile = rfile, wfile
+
+	def read_message(self):
+		header = self.rfile.read(4)
+		if not header:
+			raise EOFError
+		if len(header) != 4:
+			raise ProtocolError("Truncated frame header.")
+		length, = struct.unpack(">I", header)
+		if length > MAX_FRAME_LEN:
+			raise ProtocolError("Frame of %i bytes is too large." % length)
+		payload = self.rfile.read(length)
+		if len(payload) != length:
+			raise ProtocolError("Truncated frame.")
+		return decode_value(payload)
+
+	def write_message(self, message):
+		self.wfile.write(self.frame(message))
+		self.wfile.flush()
+
+	def frame(self, message):
+		# The bytes write_message sends for message.
+		payload = encode_value(message)
+		return struct.pack(">I", len(payload)) + payload
+
+class MultiplexedProtocol(BinaryProtocol):
+	version = 3
+
+protocols = {1: HexJSONProtocol, 2: BinaryProtocol, 3: MultiplexedProtocol}
+
+# The value encoding used inside version 2 and 3 frames. Unlike JSON, it carries str (raw bytes) and unicode
+# separately, so tokens and bonds need no hex or base64, and they arrive as the same type they were sent as.
+# Every value is a one byte tag followed by its contents, with lengths and counts as 4 byte big-endian integers:
+#   "N", "T", "F"   None, True, False
+#   "i"             an int, as 8 bytes big-endian
+#   "I"             a bigger int (like a 128-bit address index), as the length and decimal digits
+#   "d"             a float, as an 8 byte big-endian double
+#   "b"             a str, as the length and the raw bytes
+#   "u"             a unicode, as the length and the UTF-8 bytes
+#   "l"             a list or tuple, as the count and each item
+#   "m"             a dict, as the count and each key followed by its value
+# This is all Python, so a message of many small values, like a database row, costs more CPU than with version 1,
+# where the json module's C code does the work. Big strs, like tokens and protobonds, cost much less, and every
+# message is about half the size (see rpc_bench.py --codec).
+_length = struct.Struct(">I")
+_int = struct.Struct(">q")
+_float = struct.Struct(">d")
+
+def encode_value(value):
+	chunks = []
+	_encode_into(value, chunks)
+	return "".join(chunks)
+
+def _encode_into(value, chunks):
+	# The most common types are checked first. Comparing types exactly also keeps bool, a subclass of int, apart.
+	kind = type(value)
+	if kind is str:
+		chunks.append("b" + _length.pack(len(value)))
+		chunks.append(value)
+	elif kind is int or kind is long:
+		if -2**63 <= value < 2**63:
+			chunks.append("i" + _int.pack(value))
+		else:
+			digits = str(value)
+			chunks.append("I" + _length.pack(len(digits)) + digits)
+	elif kind is dict:
+		chunks.append("m" + _length.pack(len(value)))
+		for key, item in value.iteritems():
+			_encode_into(key, chunks)
+			_encode_into(item, chunks)
+	elif kind is list or kind is tuple:
+		chunks.append("l" + _length.pack(len(value)))
+		for item in value:
+			_encode_into(item, chunks)
+	elif value is None:
+		chunks.append("N")
+	elif value is True:
+		chunks.append("T")
+	elif value is False:
+		chunks.append("F")
+	elif kind is float:
+		chunks.append("d" + _float.pack(value))
+	elif kind is unicode:
+		data = value.encode("utf-8")
+		chunks.append("u" + _length.pack(len(data)))
+		chunks.append(data)
+	else:
+		for base in _BASE_TYPES:
+			if isinstance(value, base):
+				# A subclass, like an OrderedDict, goes as the type it is built on.
+				return _encode_into(base(value), chunks)
+		raise TypeError("Can't send %r over RPC." % (value,))
+
+_BASE_TYPES = (str, unicode, int, long, float, dict, list, tuple)
+
+def decode_value(data):
+	try:
+		value, offset = _decode_from(data, 0)
+	except (struct.error, IndexError, ValueError, TypeError), e:
+		raise ProtocolError("Malformed frame: %s" % e)
+	if offset != len(data):
+		raise ProtocolError("Trailing garbage in frame.")
+	return value
+
+def _decode_bytes(data, offset):
+	# The length-prefixed bytes at offset, and the offset just past them.
+	length, = _length.unpack_from(data, offset)
+	end = offset + 4 + length
+	if end > len(data):
+		raise ValueError("length runs past the end of the frame")
+	return data[offset + 4:end], end
+
+def _decode_from(data, offset):
+	tag = data[offset]
+	offset += 1
+	if tag == "b":
+		return _decode_bytes(data, offset)
+	elif tag == "i":
+		return _int.unpack_from(data, offset)[0], offset + 8
+	elif tag == "m":
+		count, = _length.unpack_from(data, offset)
+		offset += 4
+		items = {}
+		for i in xrange(count):
+			key, offset = _decode_from(data, offset)
+			items[key], offset = _decode_from(data, offset)
+		return items, offset
+	elif tag == "l":
+		count, = _length.unpack_from(data, offset)
+		offset += 4
+		items = []
+		for i in xrange(count):
+			item, offset = _decode_from(data, offset)
+			items.append(item)
+		return items, offset
+	elif tag == "N":
+		return None, offset
+	elif tag == "T":
+		return True, offset
+	elif tag == "F":
+		return False, offset
+	elif tag == "d":
+		return _float.unpack_from(data, offset)[0], offset + 8
+	elif tag == "u":
+		text, offset = _decode_bytes(data, offset)
+		return text.decode("utf-8"), offset
+	elif tag == "I":
+		digits, offset = _decode_bytes(data, offset)
+		return long(digits), offset
+	raise ValueError("unknown tag %r" % tag)
+
+# Addresses. A service's address is normally the path of its Unix socket, but "tcp:<host>:<port>" means TCP,
+# so that services can be spread over several hosts. A client can be given several addresses separated by commas,
+# which it treats as replicas of the service, spreading its calls over them in turn.
+# The address a client uses for rpc/<Service>/sock can be changed with the environment variable DRYER21_RPC_<Service>,
+# and the address a server listens on with --address (see permissions.py).
+TCP_PREFIX = "tcp:"
+# How long to wait for a TCP connection to be accepted, before counting the server as down.
+CONNECT_TIMEOUT = 5.0
+
+# TCP has none of the protection our permission separation gives Unix sockets, so before anything else is read
+# from a TCP connection, the client has to prove that it knows a secret key shared by the whole deployment:
+#   server: DRYER21-AUTH <server nonce>
+#   client: <client nonce> <HMAC-SHA256 of "client <server nonce> <client nonce">
+#   server: <HMAC-SHA256 of "server <server nonce> <client nonce">
+# The server's answer proves to the client that it isn't talking to an impostor either. Without the key file,
+# we refuse to listen on or connect to TCP at all.
+# After that, everything either side sends, starting with the protocol handshake, goes in sealed records:
+#   <length as a 4 byte big-endian integer> <that many bytes> <HMAC-SHA256 of the sequence number and the rest>
+# The MAC is keyed with a key for each direction, derived from the shared key and both nonces (see record_keys),
+# and the sequence number counts the records sent that way so far. So nobody on the path can inject, alter,
+# replay or reorder what is sent, and a record that fails the check kills the connection.
+# Note that the calls themselves are not encrypted.
+AUTH_PREFIX = "DRYER21-AUTH "
+# Relative to /dryer21, like the other data files. Every host in the deployment needs a copy of the same key.
+RPC_KEY_FILE = os.environ.get("DRYER21_RPC_KEY_FILE", "data/rpc_key/rpc_key.txt")
+# How long a TCP client gets to authenticate, before it is hung up on.
+AUTH_TIMEOUT = 10.0
+# Longer than any valid answer, so that an unauthenticated peer can't make us buffer much.
+MAX_AUTH_LINE = 256
+# Bigger messages are split over several records.
+MAX_RECORD_LEN = 1024 * 1024
+RECORD_MAC_LEN = 32
+
+class AuthenticationError(Exception):
+	pass
+
+global_rpc_key = None
+def rpc_key():
+	global global_rpc_key
+	if global_rpc_key is None:
+		try:
+			with open(RPC_KEY_FILE) as f:
+				key = f.read().strip()
+		except IOError, e:
+			raise AuthenticationError("Can't read the RPC key for TCP from %s: %s" % (RPC_KEY_FILE, e))
+		if len(key) < 32:
+			raise AuthenticationError("The RPC key in %s is too short." % RPC_KEY_FILE)
+		global_rpc_key = key
+	return global_rpc_key
+
+def auth_mac(role, server_nonce, client_nonce):
+	return hmac.new(rpc_key(), "%s %s %s" % (role, server_nonce, client_nonce), hashlib.sha256).hexdigest()
+
+def record_keys(server_nonce, client_nonce):
+	# The keys for the records sent by the client and by the server, in that order.
+	return auth_mac("client-records", server_nonce, client_nonce), auth_mac("server-records", server_nonce, client_nonce)
+
+def new_nonce():
+	return os.urandom(16).encode("hex")
+
+def auth_challenge():
+	# Returns the server's nonce, and the line to send the client.
+	server_nonce = new_nonce()
+	return server_nonce, "%s%s\n" % (AUTH_PREFIX, server_nonce)
+
+def check_client_auth(server_nonce, line):
+	# Checks the client's answer to auth_challenge.
+	# Returns the line to send back, and the record keys (see record_keys) the connection goes on with.
+	parts = line.strip().split(" ")
+	if len(parts) != 2 or not hmac.compare_digest(auth_mac("client", server_nonce, parts[0]), parts[1]):
+		raise AuthenticationError("TCP client failed to authenticate.")
+	return auth_mac("server", server_nonce, parts[0]) + "\n", record_keys(server_nonce, parts[0])
+
+def authenticate_to_server(sock_file):
+	# The client's side of the exchange, on a newly opened TCP connection. Returns the record keys.
+	challenge = sock_file.readline(MAX_AUTH_LINE)
+	if not challenge.startswith(AUTH_PREFIX):
+		raise AuthenticationError("TCP server didn't ask us to authenticate.")
+	server_nonce, client_nonce = challenge[len(AUTH_PREFIX):].strip(), new_nonce()
+	sock_file.write("%s %s\n" % (client_nonce, auth_mac("client", server_nonce, client_nonce)))
+	sock_file.flush()
+	answer = sock_file.readline(MAX_AUTH_LINE).strip()
+	if not hmac.compare_digest(auth_mac("server", server_nonce, client_nonce), answer):
+		raise AuthenticationError("TCP server failed to authenticate.")
+	return record_keys(server_nonce, client_nonce)
+
+# The sealing or checking of the records going one way on a connection.
+class RecordMAC:
+	def __init__(self, key):
+		# Keying an HMAC costs two extra hashes, so it is done once here, and copied for each record.
+		self.keyed = hmac.new(key, digestmod=hashlib.sha256)
+		self.sequence = 0
+
+	def mac(self, header, payload):
+		digest = self.keyed.copy()
+		digest.update(struct.pack(">Q", self.sequence) + header)
+		digest.update(payload)
+		self.sequence += 1
+		return digest.digest()
+
+	def seal(self, data):
+		# The records to send data in.
+		records = []
+		for start in xrange(0, len(data), MAX_RECORD_LEN):
+			payload = data[start:start + MAX_RECORD_LEN]
+			header = struct.pack(">I", len(payload))
+			records.extend((header, payload, self.mac(header, payload)))
+		return "".join(records)
+
+	def open(self, header, payload, mac):
+		# The payload of a record that was read, if it is the next one the sender sealed.
+		if not hmac.compare_digest(self.mac(header, payload), mac):
+			raise AuthenticationError("Record failed to authenticate.")
+		return payload
+
+# What the protocols read and write on an authenticated TCP connection, in place of the socket's own file(s).
+# Whatever is written is sealed in one go on each flush, and reads are served from the records received.
+class SealedFile:
+	def __init__(self, rfile, wfile, keys, is_server):
+		self.rfile, self.wfile = rfile, wfile
+		client_key, server_key = keys
+		self.sealer = RecordMAC(server_key if is_server else client_key)
+		self.opener = RecordMAC(client_key if is_server else server_key)
+		self.outgoing = []
+		self.incoming, self.position = "", 0
+
+	def write(self, data):
+		self.outgoing.append(data)
+
+	def flush(self):
+		data, self.outgoing = "".join(self.outgoing), []
+		if data:
+			self.wfile.write(self.sealer.seal(data))
+		self.wfile.flush()
+
+	def receive(self):
+		# Replace incoming with the payload of the next record. Returns False if the peer hung up instead.
+		header = self.rfile.read(4)
+		if not header:
+			return False
+		if len(header) != 4:
+			raise ProtocolError("Truncated record header.")
+		length, = struct.unpack(">I", header)
+		if length > MAX_RECORD_LEN:
+			raise ProtocolError("Record of %i bytes is too large." % length)
+		rest = self.rfile.read(length + RECORD_MAC_LEN)
+		if len(rest) != length + RECORD_MAC_LEN:
+			raise ProtocolError("Truncated record.")
+		self.incoming, self.position = self.opener.open(header, rest[:length], rest[length:]), 0
+		return True
+
+	def read(self, size):
+		pieces = []
+		while size > 0 and (self.position < len(self.incoming) or self.receive()):
+			piece = self.incoming[self.position:self.position + size]
+			self.position += len(piece)
+			size -= len(piece)
+			pieces.append(piece)
+		return "".join(pieces)
+
+	def readline(self, limit=-1):
+		pieces = []
+		while limit != 0 and (self.position < len(self.incoming) or self.receive()):
+			end = self.incoming.find("\n", self.position) + 1 or len(self.incoming)
+			if limit > 0:
+				end = min(end, self.position + limit)
+				limit -= end - self.position
+			pieces.append(self.incoming[self.position:end])
+			self.position = end
+			if pieces[-1].endswith("\n"):
+				break
+		return "".join(pieces)
+
+	@property
+	def closed(self):
+		return self.wfile.closed
+
+	def close(self):
+		for f in (self.wfile, self.rfile):
+			try:
+				f.close()
+			except socket.error:
+				pass
+
+def configured_address(socket_path):
+	parts = socket_path.split("/")
+	if len(parts) == 3 and parts[0] == "rpc" and parts[2] == "sock":
+		return os.environ.get("DRYER21_RPC_" + parts[1], socket_path)
+	return socket_path
+
+def parse_address(address):
+	# Returns ("unix", path) or ("tcp", (host, port)).
+	if not address.startswith(TCP_PREFIX):
+		return "unix", address
+	host, port = address[len(TCP_PREFIX):].rsplit(":", 1)
+	# IPv6 addresses are written in brackets, as in tcp:[::1]:7000.
+	return "tcp", (host.strip("[]"), int(port))
+
+def server_unavailable(error):
+	# Whether a socket.error from connecting means that nothing is listening at the address (yet).
+	# EACCES counts too: a server's Unix socket only becomes writable by everyone once RPCServer chmods it, just
+	# after binding, and services are all started at once, so a client can try it in between.
+	return isinstance(error, socket.timeout) or error.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ETIMEDOUT)
+
+def make_rpc_server(address):
+	# A threaded server for address.
+	transport, location = parse_address(address)
+	if transport == "unix":
+		return RPCServer(location, RPCRequestHandler)
+	return RPCTCPServer(location, RPCRequestHandler)
 
 class RPCServer(SocketServer.ThreadingUnixStreamServer):
 	def __init__(self, server_address, request_handler_class):
@@ -30,51 +811,652 @@ class RPCServer(SocketServer.ThreadingUnixStreamServer):
 		# Remember, our permission separation relies on directory permissions, so this is okay.
 		os.chmod(server_address, stat.S_IRWXO|stat.S_IRWXG|stat.S_IRWXU)
 
+class RPCTCPServer(SocketServer.ThreadingTCPServer):
+	allow_reuse_address = True
+
+	def __init__(self, server_address, request_handler_class):
+		# Fail now, rather than on the first connection, if we have no key to check clients with.
+		rpc_key()
+		self.address_family = socket.getaddrinfo(server_address[0], server_address[1], 0, socket.SOCK_STREAM)[0][0]
+		SocketServer.TCPServer.__init__(self, server_address, request_handler_class)
+
+	def get_request(self):
+		sock, address = SocketServer.TCPServer.get_request(self)
+		# Our messages are small and each one is written in one go, so don't let Nagle's algorithm hold them up.
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return sock, address
+
 class RPCRequestHandler(SocketServer.StreamRequestHandler):
+	def authenticate(self):
+		# Only for TCP. See auth_challenge.
+		self.connection.settimeout(AUTH_TIMEOUT)
+		server_nonce, challenge = auth_challenge()
+		self.wfile.write(challenge)
+		self.wfile.flush()
+		answer, keys = check_client_auth(server_nonce, self.rfile.readline(MAX_AUTH_LINE))
+		self.wfile.write(answer)
+		self.wfile.flush()
+		self.connection.settimeout(None)
+		self.rfile = self.wfile = SealedFile(self.rfile, self.wfile, keys, is_server=True)
+
+	def negotiate(self):
+		# Returns the protocol for this connection, and the first version 1 line if there was no handshake.
+		line = self.rfile.readline()
+		if not line.startswith(HANDSHAKE_PREFIX):
+			return HexJSONProtocol(self.rfile, self.wfile), line
+		try:
+			version = min(int(line[len(HANDSHAKE_PREFIX):]), PROTOCOL_VERSION)
+		except ValueError:
+			raise ProtocolError("Bad handshake: %r" % line)
+		if version not in protocols:
+			raise ProtocolError("Unsupported protocol version: %r" % version)
+		self.wfile.write("%s%i\n" % (HANDSHAKE_PREFIX, version))
+		self.wfile.flush()
+		return protocols[version](self.rfile, self.wfile), None
+
 	def handle(self):
-		print "[%s] Opening a connection." % global_socket_path
+		logger.debug("[%s] Opening a connection.", global_socket_path)
+		# Connections stay open between calls for as long as the client likes, whatever socket.setdefaulttimeout says.
+		self.connection.settimeout(None)
+		if isinstance(self.server, RPCTCPServer):
+			try:
+				self.authenticate()
+			except (AuthenticationError, socket.timeout), e:
+				logger.warning("[%s] Hanging up on %s: %s", global_socket_path, self.client_address[0], e)
+				return
+		# Let exceptions happen here.
+		# They will kill this handler, but be handled gracefully by SocketServer.
+		protocol, first_line = self.negotiate()
+		if protocol.version >= 3:
+			return self.handle_multiplexed(protocol)
 		while True:
-			# Let exceptions happen here.
-			# They will kill this handler, but be handled gracefully by SocketServer.
-			line = self.rfile.readline().strip().decode("hex")
-			method, kwargs = json.loads(line)
-			with global_rpc_server_lock:
-				print "[%s] Call to %r on %r" % (global_socket_path, method, kwargs)
-				# Look up the method in our RPC table.
-				function = global_rpc_table[method]
+			try:
+				if first_line is not None:
+					request = protocol.read_message(first_line)
+					first_line = None
+				else:
+					request = protocol.read_message()
+			except EOFError:
+				# The client hung up between calls, which is the normal way for a connection to end.
+				return
+			# Send the result back over the RPC link.
+			protocol.write_message(self.dispatch(*request))
+
+	def handle_multiplexed(self, protocol):
+		write_lock = threading.Lock()
+		slots = threading.Semaphore(MAX_IN_FLIGHT_PER_CONNECTION)
+		def run(request):
+			try:
+				request_id = request[0]
 				try:
-					# Perform the actual RPC call.
-					return_value = function(**kwargs)
-					message = ("good", return_value)
-				except RPCException, e:
-					# In case of an RPC Exception, signal to the caller that something bad happened.
-					message = ("bad", e.message)
-				# Send message back as a JSON object over the RPC link.
-				data = json.dumps(message).encode("hex")
-				self.wfile.write(data + "\n")
-				self.wfile.flush()
+					status, result = self.dispatch(*request[1:])
+				except Exception, e:
+					# Other calls may be running on this connection, so only this one is answered with the failure.
+					traceback.print_exc()
+					status, result = "error", repr(e)
+				with write_lock:
+					protocol.write_message([request_id, status, result])
+			except:
+				# A request we can't even answer, or a connection we can't write to, kills the connection.
+				traceback.print_exc()
+				self.request.shutdown(socket.SHUT_RDWR)
+			finally:
+				slots.release()
+		while True:
+			try:
+				request = protocol.read_message()
+			except EOFError:
+				break
+			slots.acquire()
+			thread = threading.Thread(target=run, args=(request,))
+			thread.daemon = True
+			thread.start()
+		# Let any calls still running finish before SocketServer closes the connection.
+		for i in xrange(MAX_IN_FLIGHT_PER_CONNECTION):
+			slots.acquire()
+
+	def dispatch(self, method, kwargs, options=None):
+		function, policy = lookup_method(method, kwargs)
+		stats = method_stats(method, kwargs)
+		stats.begin()
+		arrived = started = time.time()
+		deadline = request_deadline(options, arrived)
+		status = "error"
+		try:
+			try:
+				if expired(deadline):
+					raise RPCTimeout("Deadline expired before %s started." % method)
+				with policy:
+					started = time.time()
+					# The wait for the lock may have used up the rest of the caller's time.
+					if expired(deadline):
+						raise RPCTimeout("Deadline expired while %s waited to run." % method)
+					call_context.deadline = deadline
+					try:
+						# Perform the actual RPC call.
+						result = function(**kwargs)
+						if isinstance(result, types.GeneratorType):
+							result = run_coroutine(result)
+					finally:
+						call_context.deadline = None
+				status = "good"
+			except RPCException, e:
+				# In case of an RPC Exception, signal to the caller that something bad happened.
+				status, result = response_status(e), e.message
+		finally:
+			finished = time.time()
+			stats.end(finished - arrived, started - arrived, status)
+		log_call(method, kwargs, status, finished - arrived)
+		return (status, result)
+
+def request_deadline(options, arrived):
+	# The deadline for a request that arrived at the given time.
+	if options and options.get("timeout") is not None:
+		return arrived + options["timeout"]
+	return None
+
+# Every RPCClient in this process, so that prefork workers can drop the connections they inherit.
+global_rpc_clients = []
+
+# Raised by RPCConnection.exchange when the server had already hung up before any of the request went out,
+# so the call certainly never ran, and can be made again on another connection.
+class StaleConnection(Exception):
+	pass
+
+# A single connection to an RPC server, which can carry one call at a time.
+class RPCConnection:
+	def __init__(self, address, max_protocol_version):
+		self.address = address
+		transport, location = parse_address(address)
+		if transport == "unix":
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.connect(location)
+		else:
+			# Don't even connect without the key, or a problem with it would look like a server being down.
+			rpc_key()
+			self.sock = socket.create_connection(location, CONNECT_TIMEOUT)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.sock_file = self.sock.makefile()
+		if transport == "tcp":
+			try:
+				self.sock.settimeout(AUTH_TIMEOUT)
+				keys = authenticate_to_server(self.sock_file)
+				self.sock_file = SealedFile(self.sock_file, self.sock_file, keys, is_server=False)
+			except:
+				self.close()
+				raise
+		# Calls set their own timeouts (see exchange). Until then, block, whatever socket.setdefaulttimeout says.
+		self.sock.settimeout(None)
+		if max_protocol_version < 2:
+			self.protocol = HexJSONProtocol(self.sock_file, self.sock_file)
+			return
+		self.sock_file.write("%s%i\n" % (HANDSHAKE_PREFIX, max_protocol_version))
+		self.sock_file.flush()
+		try:
+			reply = self.sock_file.readline()
+		except socket.error:
+			reply = ""
+		if not reply.startswith(HANDSHAKE_PREFIX):
+			# Servers that predate the handshake choke on it and hang up.
+			self.close()
+			raise ProtocolError("Server does not support the handshake.")
+		self.protocol = protocols[int(reply[len(HANDSHAKE_PREFIX):])](self.sock_file, self.sock_file)
+
+	def exchange(self, method, kwargs, deadline=None):
+		# Make a single call, and wait for its response.
+		# With a deadline, this raises socket.timeout if the response doesn't arrive in time,
+		# after which the connection is out of step with the server and must be discarded.
+		request = [method, kwargs] + request_options(self.protocol, deadline)
+		if self.protocol.version >= 3:
+			request = [0] + request
+		if self.hung_up():
+			raise StaleConnection()
+		self.sock.settimeout(None if deadline is None else max(deadline - time.time(), 0.001))
+		try:
+			self.protocol.write_message(request)
+		except socket.error:
+			# The write failed, so the server can't have read the whole request.
+			raise StaleConnection()
+		if self.protocol.version < 3:
+			return self.protocol.read_message()
+		request_id, status, result = self.protocol.read_message()
+		return status, result
+
+	def hung_up(self):
+		# Whether the server has closed this idle connection, which we can tell without sending anything.
+		# Nothing else should be waiting to be read between calls, so anything readable means it is no good.
+		try:
+			readable, writable, errors = select.select([self.sock], [], [], 0)
+		except (select.error, socket.error):
+			return True
+		return bool(readable)
+
+	def close(self):
+		try:
+			self.sock_file.close()
+		except socket.error:
+			# Closing flushes any half-written request, which fails if the server is gone. We don't care.
+			pass
+		self.sock.close()
+
+def request_options(protocol, deadline):
+	# The options to append to a request, if any. Version 1 has no room for them, so there it goes without.
+	if deadline is None or protocol.version < 2:
+		return []
+	return [{"timeout": max(deadline - time.time(), 0.0)}]
+
+# The result of a call made with call_async, which will be filled in when the response arrives.
+# If the call has a deadline, waiting for the result gives up at that deadline.
+class RPCFuture:
+	def __init__(self, deadline=None):
+		self.deadline = deadline
+		self.event = threading.Event()
+		self.lock = threading.Lock()
+		self.callbacks = []
+		self.status = self.value = None
+
+	def set_result(self, status, value):
+		# status is "good", "bad", "timeout" or "error", as on the wire, or "failed" with an exception instance as the value.
+		with self.lock:
+			self.status, self.value = status, value
+			self.event.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			callback(self)
+
+	def done(self):
+		return self.event.is_set()
+
+	def add_done_callback(self, callback):
+		# The callback is called with the future, right away if it's already done.
+		with self.lock:
+			if not self.event.is_set():
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+	def result(self, timeout=None):
+		# Wait for the call to finish, and return its result or raise its exception, just like RPCClient.call.
+		if timeout is None and self.deadline is not None:
+			timeout = max(self.deadline - time.time(), 0.0)
+		if not self.event.wait(timeout):
+			raise RPCTimeout("Timed out waiting for an RPC result.")
+		if self.status == "good":
+			return self.value
+		elif self.status == "bad":
+			raise RPCException(self.value)
+		elif self.status == "timeout":
+			raise RPCTimeout(self.value)
+		elif self.status == "error":
+			raise RPCServerError(self.value)
+		elif self.status == "failed":
+			raise self.value
+		raise Exception("Protocol violation!")
+
+# A version 3 connection with any number of calls outstanding at once.
+# A reader thread matches responses to their futures by request ID.
+# Requests are normally written by whoever submits them, but sending can block, if the server is slow to read,
+# and an event loop must never block, so requests submitted from one are handed to a writer thread instead.
+class MultiplexedConnection:
+	def __init__(self, connection):
+		self.connection = connection
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self.pending = {}
+		self.next_id = 1
+		self.dead = False
+		# Frames for the writer thread, which is started on first use. None tells it to stop.
+		self.outgoing = Queue.Queue()
+		self.writer = None
+		reader = threading.Thread(target=self.read_responses)
+		reader.daemon = True
+		reader.start()
+
+	def submit(self, method, kwargs, deadline=None):
+		future = RPCFuture(deadline)
+		with self.lock:
+			if self.dead:
+				raise Exception("RPC server hung up!")
+			request_id = self.next_id
+			self.next_id += 1
+			self.pending[request_id] = future
+		try:
+			data = self.connection.protocol.frame([request_id, method, kwargs] + request_options(self.connection.protocol, deadline))
+			if getattr(event_loop_thread, "active", False):
+				self.send_later(data)
+			else:
+				self.send(data)
+		except:
+			with self.lock:
+				self.pending.pop(request_id, None)
+			raise
+		return future
+
+	def send(self, data):
+		with self.write_lock:
+			self.connection.sock_file.write(data)
+			self.connection.sock_file.flush()
+
+	def send_later(self, data):
+		with self.lock:
+			if self.dead:
+				raise Exception("RPC server hung up!")
+			if self.writer is None:
+				self.writer = threading.Thread(target=self.write_requests)
+				self.writer.daemon = True
+				self.writer.start()
+			self.outgoing.put(data)
+
+	def write_requests(self):
+		while True:
+			data = self.outgoing.get()
+			if data is None:
+				return
+			try:
+				self.send(data)
+			except Exception:
+				# Hang up, so that the reader thread fails everything still waiting on the connection.
+				try:
+					self.connection.sock.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					pass
+				return
+
+	def read_responses(self):
+		try:
+			while True:
+				request_id, status, result = self.connection.protocol.read_message()
+				with self.lock:
+					future = self.pending.pop(request_id)
+				future.set_result(status, result)
+		except Exception, e:
+			error = e
+		# The connection is gone. Fail everything still waiting on it.
+		with self.lock:
+			self.dead = True
+			pending, self.pending = self.pending, {}
+			self.outgoing.put(None)
+		self.connection.close()
+		for future in pending.values():
+			future.set_result("failed", Exception("RPC server hung up! (%s)" % (error,)))
+
+# How long clients wait for a server to start accepting connections, and how often they try.
+READY_TIMEOUT = 30.0
+CONNECT_RETRY_DELAY = 0.05
+MAX_CONNECT_RETRY_DELAY = 1.0
+# The pooled connections carry one call at a time, which version 2 does with less work on both ends than version 3,
+# whose server runs every request on a thread of its own. Only the multiplexed connections of call_async use 3.
+SYNC_PROTOCOL_VERSION = 2
 
 # This class is the entirety of the API for declaring an RPC client.
+# It is safe to share between threads: it keeps a pool of up to pool_size connections, and each call checks one out.
+# If a pooled connection turns out to be dead (for instance because the server restarted) the call is retried once
+# on a new connection, so callers never see a stale connection.
+# Every call is bounded by the current deadline (see deadline), and by timeout seconds if that is given.
+# Nothing is connected until the first call, and while the server isn't accepting connections yet (say because
+# it is still starting up, or restarting) connecting is retried with backoff for up to ready_timeout seconds.
+# So clients can be made at import time whether or not their server is up, and services can start in any order.
+# With several replicas, each call goes to the next one in turn, skipping any that aren't accepting connections.
 class RPCClient:
-	def __init__(self, socket_path):
+	def __init__(self, socket_path, max_protocol_version=PROTOCOL_VERSION, pool_size=8, timeout=None, ready_timeout=READY_TIMEOUT):
 		self.socket_path = socket_path
-		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-		self.sock.connect(self.socket_path)
-		self.sock_file = self.sock.makefile()
+		self.addresses = configured_address(socket_path).split(",")
+		self.next_replica = 0
+		self.max_protocol_version = max_protocol_version
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.ready_timeout = ready_timeout
+		self.condition = threading.Condition()
+		self.idle = []
+		self.open_count = 0
+		# Asynchronous calls share multiplexed connections, a list of them per replica (see find_multiplexed).
+		self.multiplexed = {}
+		self.multiplexed_lock = threading.Lock()
+		self.can_multiplex = True
+		# Counters, as reported by stats().
+		self.calls = self.waits = self.reconnects = self.connect_retries = 0
+		self.wait_time = 0.0
+		global_rpc_clients.append(self)
 
-	def call(self, method, kwargs):
-		line = json.dumps([method, kwargs]).encode("hex") + "\n"
-		self.sock_file.write(line)
-		self.sock_file.flush()
-		response = self.sock_file.readline().strip().decode("hex")
-		status, result = json.loads(response)
+	def pick_address(self):
+		# The replica for the next call.
+		with self.condition:
+			address = self.addresses[self.next_replica % len(self.addresses)]
+			self.next_replica += 1
+		return address
+
+	def connect(self, deadline=None, address=None, multiplexed=False):
+		# Connect to address, or if nothing is listening there, to the next replica that is.
+		start = self.addresses.index(address) if address is not None else self.addresses.index(self.pick_address())
+		addresses = self.addresses[start:] + self.addresses[:start]
+		give_up = earliest(deadline, time.time() + self.ready_timeout)
+		delay = CONNECT_RETRY_DELAY
+		while True:
+			for address in addresses:
+				try:
+					return self.open_connection(address, multiplexed)
+				except socket.error, e:
+					# Anything but nobody listening is a real problem.
+					if not server_unavailable(e):
+						raise
+					error = sys.exc_info()
+			remaining = give_up - time.time()
+			if remaining <= 0:
+				if give_up == deadline:
+					raise RPCTimeout("Deadline expired waiting for %s to come up." % self.socket_path)
+				raise error[0], error[1], error[2]
+			with self.condition:
+				self.connect_retries += 1
+			time.sleep(min(delay, remaining))
+			delay = min(delay * 2, MAX_CONNECT_RETRY_DELAY)
+
+	def open_connection(self, address, multiplexed=False):
+		version = self.max_protocol_version if multiplexed else min(self.max_protocol_version, SYNC_PROTOCOL_VERSION)
+		try:
+			return RPCConnection(address, version)
+		except ProtocolError:
+			if version < 2:
+				raise
+			# Stick to the original protocol from now on.
+			self.max_protocol_version = 1
+			return RPCConnection(address, self.max_protocol_version)
+
+	def checkout(self, deadline=None):
+		# Returns a connection, and whether it came out of the pool (as opposed to being newly opened).
+		with self.condition:
+			if not self.idle and self.open_count >= self.pool_size:
+				self.waits += 1
+				start = time.time()
+				try:
+					while not self.idle and self.open_count >= self.pool_size:
+						if expired(deadline):
+							raise RPCTimeout("Deadline expired waiting for a connection to %s." % self.socket_path)
+						self.condition.wait(None if deadline is None else deadline - time.time())
+				finally:
+					self.wait_time += time.time() - start
+			self.calls += 1
+			address = self.pick_address()
+			# Prefer an idle connection to the replica whose turn it is, or else open one if there's room.
+			for i in reversed(xrange(len(self.idle))):
+				if self.idle[i].address == address:
+					return self.idle.pop(i), True
+			if self.idle and self.open_count >= self.pool_size:
+				return self.idle.pop(), True
+			self.open_count += 1
+		try:
+			return self.connect(deadline, address), False
+		except:
+			self.discard(None)
+			raise
+
+	def release(self, connection):
+		with self.condition:
+			self.idle.append(connection)
+			self.condition.notify()
+
+	def discard(self, connection):
+		if connection is not None:
+			connection.close()
+		with self.condition:
+			self.open_count -= 1
+			self.condition.notify()
+
+	def reset_after_fork(self):
+		# The connections we inherited belong to our parent. Closing our copies doesn't disturb it.
+		with self.condition:
+			for connection in self.idle:
+				connection.close()
+			self.idle = []
+			self.open_count = 0
+			self.multiplexed = {}
+			# Another thread may have held this at the fork, and that thread doesn't exist here.
+			self.multiplexed_lock = threading.Lock()
+
+	def server_stats(self):
+		# Ask the server for its metrics.
+		return self.call(STATS_METHOD, {})
+
+	def stats(self):
+		with self.condition:
+			return {
+				"pool_size": self.pool_size,
+				"open": self.open_count,
+				"idle": len(self.idle),
+				"in_use": self.open_count - len(self.idle),
+				"calls": self.calls,
+				"waits": self.waits,
+				"wait_time": self.wait_time,
+				"reconnects": self.reconnects,
+				"connect_retries": self.connect_retries,
+				"multiplexed": sum(len(connections) for connections in self.multiplexed.values()),
+			}
+
+	def deadline_for(self, timeout=None):
+		# The deadline for a call made now: the earliest of the current deadline and any timeouts that apply.
+		now = time.time()
+		return earliest(
+			current_deadline(),
+			now + timeout if timeout is not None else None,
+			now + self.timeout if self.timeout is not None else None,
+		)
+
+	def call(self, method, kwargs, timeout=None):
+		deadline = self.deadline_for(timeout)
+		while True:
+			# Don't send work the server would only throw away.
+			if expired(deadline):
+				raise RPCTimeout("Deadline expired before calling %s on %s." % (method, self.socket_path))
+			connection, reused = self.checkout(deadline)
+			try:
+				status, result = connection.exchange(method, kwargs, deadline)
+			except StaleConnection:
+				# The server closed a connection that sat in the pool, and the call never went out, so make it again.
+				self.discard(connection)
+				if not reused:
+					raise Exception("RPC server hung up!")
+				with self.condition:
+					self.reconnects += 1
+				continue
+			except socket.timeout:
+				self.discard(connection)
+				raise RPCTimeout("Timed out waiting for %s on %s." % (method, self.socket_path))
+			except (EOFError, socket.error, IOError):
+				# The request went out, and may have run, so it isn't safe to make it again.
+				self.discard(connection)
+				raise Exception("RPC server hung up!")
+			except:
+				# Anything else leaves the connection in an unknown state.
+				self.discard(connection)
+				raise
+			self.release(connection)
+			break
 		if status == "good":
 			return result
 		elif status == "bad":
 			# Transparently pass the exception through.
 			raise RPCException(result)
+		elif status == "timeout":
+			raise RPCTimeout(result)
+		elif status == "error":
+			raise RPCServerError(result)
 		raise Exception("Protocol violation!")
 
+	def call_async(self, method, kwargs, timeout=None):
+		# Start a call without waiting for it, and return an RPCFuture for its result.
+		deadline = self.deadline_for(timeout)
+		address = self.pick_address()
+		multiplexed = self.find_multiplexed(address)
+		if self.can_multiplex and multiplexed is None and getattr(event_loop_thread, "active", False):
+			# Connecting may mean waiting for the server to come up, which an event loop must not do,
+			# so make the call from a thread instead. Once connected, calls are submitted right from the loop.
+			saved, call_context.deadline = current_deadline(), deadline
+			try:
+				return run_in_thread(lambda: self.call_async(method, kwargs).result())
+			finally:
+				call_context.deadline = saved
+		with self.condition:
+			self.calls += 1
+		with self.multiplexed_lock:
+			multiplexed = self.find_multiplexed(address)
+			if self.can_multiplex and multiplexed is None:
+				# If that replica is down, this connects to another one, and we use its connection.
+				connection = self.connect(deadline, address, multiplexed=True)
+				if connection.protocol.version < 3:
+					connection.close()
+					self.can_multiplex = False
+				else:
+					multiplexed = self.find_multiplexed(connection.address)
+					if multiplexed is None:
+						multiplexed = MultiplexedConnection(connection)
+						live = [other for other in self.multiplexed.get(connection.address, []) if not other.dead]
+						self.multiplexed[connection.address] = live + [multiplexed]
+					else:
+						connection.close()
+		if multiplexed is not None:
+			return multiplexed.submit(method, kwargs, deadline)
+		# The server can't multiplex, so make an ordinary call on a thread of its own.
+		future = RPCFuture(deadline)
+		def run():
+			call_context.deadline = deadline
+			try:
+				future.set_result("good", self.call(method, kwargs))
+			except RPCTimeout, e:
+				future.set_result("timeout", e.message)
+			except RPCException, e:
+				future.set_result("bad", e.message)
+			except Exception, e:
+				future.set_result("failed", e)
+		thread = threading.Thread(target=run)
+		thread.daemon = True
+		thread.start()
+		return future
+
+	def find_multiplexed(self, address):
+		# A live multiplexed connection to address with room for another call, or None.
+		# The server runs at most MAX_IN_FLIGHT_PER_CONNECTION calls at once from each connection, and leaves the rest
+		# waiting, so once every connection has that many outstanding, call_async opens another one.
+		for multiplexed in self.multiplexed.get(address, []):
+			if not multiplexed.dead and len(multiplexed.pending) < MAX_IN_FLIGHT_PER_CONNECTION:
+				return multiplexed
+		return None
+
+	def call_many(self, method, kwargs_list):
+		# Make a whole batch of calls to one method in a single round trip.
+		# Returns a list with one entry per call: its result, or an RPCException instance if that call failed.
+		if not kwargs_list:
+			return []
+		results = []
+		for status, result in self.call(BATCH_METHOD, {"method": method, "calls": list(kwargs_list)}):
+			if status == "good":
+				results.append(result)
+			elif status == "bad":
+				results.append(RPCException(result))
+			elif status == "timeout":
+				results.append(RPCTimeout(result))
+			else:
+				raise Exception("Protocol violation!")
+		return results
+
 	def make_stub(self, method):
 		# Return a stub that calls into the closed-over RPC client.
 		def rpc_stub(*args, **kwargs):
@@ -82,23 +1464,119 @@ class RPCClient:
 			return self.call(method, kwargs)
 		return rpc_stub
 
-def launch_rpc_server(import_name):
+	def make_async_stub(self, method):
+		# Like make_stub, but the stub returns an RPCFuture instead of waiting for the result.
+		def rpc_async_stub(*args, **kwargs):
+			assert len(args) == 0, "All RPC args must be keywords!"
+			return self.call_async(method, kwargs)
+		return rpc_async_stub
+
+	def make_batch_stub(self, method):
+		# Like make_stub, but the stub takes a list of keyword argument dicts, and returns what call_many does.
+		def rpc_batch_stub(kwargs_list):
+			return self.call_many(method, kwargs_list)
+		return rpc_batch_stub
+
+	def make_page_iterator(self, method):
+		# For a paginated method, a stub that returns an iterator over all its rows (see iterate_pages).
+		# It takes the method's other arguments, and limit to set the page size.
+		stub = self.make_stub(method)
+		def rpc_page_iterator(**kwargs):
+			return iterate_pages(stub, **kwargs)
+		return rpc_page_iterator
+
+def spawn_worker(server):
+	pid = os.fork()
+	if pid != 0:
+		return pid
+	# We are the worker. Any RPC client connections we inherited are shared with our siblings,
+	# and calls from several processes would interleave on them, so start with empty pools.
+	for client in global_rpc_clients:
+		client.reset_after_fork()
+	try:
+		server.serve_forever()
+	except:
+		traceback.print_exc()
+	# Never fall back into the supervisor's code.
+	os._exit(1)
+
+def launch_rpc_server(import_name, workers=1, engine="threaded", address=None):
 	# Prevent a double import issue, where one copy is called __main__, and the other is rpc_lib.
 	sys.modules["rpc_lib"] = sys.modules[__name__]
 	# Now import the desired module, to scoop up the actual code we are offering over RPC.
 	# This also has the side effect of setting global_socket_path.
 	__import__(import_name)
-	print "Launching RPC server: import_name=%r socket_path=%r" % (import_name, global_socket_path)
+	# We listen on our Unix socket, unless told otherwise.
+	address = address or global_socket_path
+	print "Launching RPC server: import_name=%r socket_path=%r address=%r workers=%i engine=%s" % (import_name, global_socket_path, address, workers, engine)
 	# Now launch the server.
-	server = RPCServer(global_socket_path, RPCRequestHandler)
-	server.serve_forever()
+	if engine == "threaded":
+		server = make_rpc_server(address)
+	elif engine == "eventloop":
+		import rpc_eventloop
+		server = rpc_eventloop.EventLoopServer(address)
+	else:
+		raise ValueError("Unknown engine: %r" % engine)
+	if workers == 1:
+		server.serve_forever()
+		return
+	# In prefork mode every worker process accepts on the same listening socket, and the kernel hands each new
+	# connection to one of them. This lets CPU-bound services use more than one core despite the GIL.
+	# We stay behind as a supervisor, and replace any worker that dies.
+	children = set(spawn_worker(server) for i in xrange(workers))
+	while True:
+		pid, status = os.wait()
+		if pid in children:
+			print "[%s] Worker %i exited with status %i, respawning." % (global_socket_path, pid, status)
+			children.remove(pid)
+			children.add(spawn_worker(server))
+
+def format_server_stats(report):
+	# Render a STATS_METHOD report as a table, with percentiles estimated from the latency histograms.
+	lines = ["%s (pid %i, up %is)" % (report["socket_path"], report["pid"], report["uptime"])]
+	lines.append("%-32s %8s %6s %6s %9s %9s %9s %11s" % ("method", "calls", "errors", "active", "mean ms", "p50 ms", "p99 ms", "lock ms/call"))
+	for name, method in sorted(report["methods"].items()):
+		calls = max(method["calls"], 1)
+		def percentile(fraction):
+			remaining = fraction * method["calls"]
+			for bound, count in method["latency_histogram"]:
+				remaining -= count
+				if remaining <= 0:
+					return "%.1f" % (bound * 1000) if bound is not None else "inf"
+			return "-"
+		lines.append("%-32s %8i %6i %6i %9.1f %9s %9s %11.2f" % (name, method["calls"], method["errors"], method["in_flight"],
+			method["total_latency"] / calls * 1000, percentile(0.5), percentile(0.99), method["total_lock_wait"] / calls * 1000))
+	for socket_path, client in sorted(report["clients"].items()):
+		lines.append("client of %s: %r" % (socket_path, client))
+	for name, extra in sorted(report.get("extra", {}).items()):
+		lines.append("%s: %r" % (name, extra))
+	return "\n".join(lines)
 
 if __name__ == "__main__":
-	if len(sys.argv) == 3 and sys.argv[1] == "--launch":
-		launch_rpc_server(import_name=sys.argv[2])
+	arguments = sys.argv[1:]
+	if len(arguments) == 2 and arguments[0] == "--stats":
+		print format_server_stats(RPCClient(arguments[1], ready_timeout=0).server_stats())
 		exit()
-	print "Usage: rpc_lib.py --launch <import>"
+	if len(arguments) >= 2 and len(arguments) % 2 == 0 and arguments[0] == "--launch":
+		options = dict(zip(arguments[2::2], arguments[3::2]))
+		if set(options) <= set(["--workers", "--engine", "--log-level", "--address"]):
+			configure_logging(options.get("--log-level", "INFO"))
+			launch_rpc_server(
+				import_name=arguments[1],
+				workers=int(options.get("--workers", 1)),
+				engine=options.get("--engine", "threaded"),
+				address=options.get("--address"),
+			)
+			exit()
+	print "Usage: rpc_lib.py --launch <import> [--workers <count>] [--engine threaded|eventloop] [--log-level <level>] [--address <address>]"
+	print "       rpc_lib.py --stats <address>"
 	print
 	print "Launches an RPC server exposing every function that has expose_rpc as a"
 	print "decorator in the file reached by running __import__ on the <import> argument."
-
+	print "With --workers, that many processes serve the socket instead of one."
+	print "With --engine eventloop, each process serves every connection from one event loop"
+	print "thread (see rpc_eventloop.py) instead of using a thread per connection."
+	print "With --log-level DEBUG, every call is logged."
+	print "With --address tcp:<host>:<port>, the server listens there instead of on its Unix socket."
+	print
+	print "With --stats, prints the metrics of the server listening on <address>, a socket path or tcp:<host>:<port>."
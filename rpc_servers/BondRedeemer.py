@@ -14,7 +14,8 @@ from rpc_clients import RedeemerDB
 
 rpc_lib.set_rpc_socket_path("rpc/BondRedeemer/sock")
 
-@rpc_lib.expose_rpc
+# Double-spending is caught by RedeemerDB.try_to_redeem, which is atomic, so redemptions don't need to wait on each other.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def bond_redeem(bond, address):
 	"""
 	Given a bond and an address, verifies the bond and then adds the bond and address to the RedeemerDB for later redemption.
@@ -7,13 +7,93 @@ Given a bitcoin address and a price, checks whether that wallet contains that am
 This implementation relies on blockchain.info for information about wallet balances. This means that the runners of blockchain.info could easily steal all our money. Were we actually running this service for real we'd instead have a bitcoin client running on the server with a local copy of the blockchain.
 Additionally this implementation doesn't check that a transaction has confirmed yet. Again, were we running the service for real we'd be sure the transactions had confirmed.
 """
-import bitcoin
-import rpc_lib
+import threading, time, json, urllib2
+
+import rpc_lib, cache_lib
 
 rpc_lib.set_rpc_socket_path("rpc/Check/sock")
 
-@rpc_lib.expose_rpc
-def check(address, price):
-	unspent_transactions = bitcoin.unspent(address) # Returns a list of dicts with the keys 'output' and 'value'
-	total_balance = sum(transaction['value'] for transaction in unspent_transactions) # in satoshi
-	return total_balance >= price
+# The longest we wait on a lookup, even for callers with no deadline of their own.
+# This is also the timeout of the lookup's own connection, so that a stalled lookup can't keep its thread forever.
+LOOKUP_TIMEOUT = 20
+
+# Clients poll until they have paid, so the same addresses get checked over and over. The last balance looked up
+# for each address is cached, as (balance, when it was looked up). A balance that covers the price is good for
+# good: the money is there, and once it is swept, the Collector (which doesn't use the cache) is the only one
+# that needs to know. A balance that falls short is only trusted for UNPAID_TTL seconds, so a payment is
+# noticed at most that long after it arrives.
+PAYMENT_CACHE_SIZE = 100000
+UNPAID_TTL = 15
+balances = cache_lib.LRUCache(PAYMENT_CACHE_SIZE)
+rpc_lib.register_stats("payment_cache", balances.stats)
+
+# The lookup in flight for each address, so that checks of the same address at the same time share one lookup.
+lookups = {}
+lookups_lock = threading.Lock()
+
+# This is the request bitcoin.unspent makes, which we make ourselves, as it takes no timeout.
+UNSPENT_URL = "https://blockchain.info/unspent?active=%s"
+
+def balance(address):
+	try:
+		data = urllib2.urlopen(UNSPENT_URL % address, timeout=LOOKUP_TIMEOUT).read()
+	except urllib2.HTTPError, e:
+		# This is how blockchain.info answers for an address with nothing in it.
+		if e.code == 500 and e.read().strip() == "No free outputs to spend":
+			return 0
+		raise
+	return sum(output['value'] for output in json.loads(data)['unspent_outputs']) # in satoshi
+
+def lookup_balance(address):
+	# Returns an RPCFuture for the balance of address, which gives up at the caller's deadline.
+	# Callers that come along while a lookup is in flight join it, so it has a deadline of its own, LOOKUP_TIMEOUT
+	# from when it started, rather than that of whoever started it: each caller waits on it for as long as they like.
+	with lookups_lock:
+		lookup = lookups.get(address)
+		started = lookup is None or rpc_lib.expired(lookup.deadline)
+		if started:
+			saved, rpc_lib.call_context.deadline = rpc_lib.current_deadline(), time.time() + LOOKUP_TIMEOUT
+			try:
+				lookup = lookups[address] = rpc_lib.run_in_thread(balance, address)
+			finally:
+				rpc_lib.call_context.deadline = saved
+	# If the lookup is already done, this calls finished right away, so it has to be outside the lock.
+	if started:
+		lookup.add_done_callback(lambda lookup: finished(address, lookup))
+	# There's no use waiting past the lookup's own deadline, as it is abandoned then.
+	result = rpc_lib.RPCFuture(rpc_lib.earliest(rpc_lib.current_deadline(), lookup.deadline))
+	lookup.add_done_callback(lambda lookup: result.set_result(lookup.status, lookup.value))
+	return result
+
+def finished(address, lookup):
+	with lookups_lock:
+		if lookups.get(address) is lookup:
+			del lookups[address]
+		if lookup.status == "good":
+			# Keep the highest balance seen: it only goes down when the Collector sweeps it, and a balance that
+			# was high enough should stay so.
+			cached = balances.peek(address)
+			if cached is not cache_lib.MISSING:
+				balances.put(address, (max(lookup.value, cached[0]), time.time()))
+			else:
+				balances.put(address, (lookup.value, time.time()))
+
+# Each check is an independent network lookup, so don't make checks wait on each other.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def check(address, price, use_cache=True):
+	# This runs on an event loop (see permissions.py), so the blocking lookup goes to a thread.
+	# With use_cache=False, this always looks up the balance as it is now, and leaves the cache alone.
+	if not use_cache:
+		with rpc_lib.deadline(LOOKUP_TIMEOUT):
+			lookup = rpc_lib.run_in_thread(balance, address)
+		total_balance = yield lookup
+		raise rpc_lib.Return(total_balance >= price)
+	cached = balances.get(address)
+	if cached is not cache_lib.MISSING:
+		total_balance, checked_at = cached
+		if total_balance >= price:
+			raise rpc_lib.Return(True)
+		if time.time() < checked_at + UNPAID_TTL:
+			raise rpc_lib.Return(False)
+	total_balance = yield lookup_balance(address)
+	raise rpc_lib.Return(total_balance >= price)
@@ -19,7 +19,8 @@ import rpc_lib
 
 rpc_lib.set_rpc_socket_path("rpc/GenQuote/sock")
 
-@rpc_lib.expose_rpc
+# SellerDB.get_or_create makes concurrent quotes for the same token safe, so quotes don't need to wait on each other.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def gen_quote(token):
 	"""
 	Given a token, adds (token, index, price, timestamp) to the database, and returns (addr, price)
@@ -36,19 +37,20 @@ def gen_quote(token):
 	if not sanetoken(token):
 		raise rpc_lib.RPCException("Token not sane.")
 
-	# FIXME: Should we be worried about race conditions here?
+	# Clients ask for a quote again each time they come back, so look for the one we already gave first. This is
+	# usually served from SellerDB's cache, and saves deriving an address that would go unused.
 	dbentry = SellerDB.get(token=token)
-	if dbentry != None: # This token is already in the database.
-		index, address, price = dbentry['index'], dbentry['address'], dbentry['price']
-		assert address == bitcoin.electrum_address(mpk, index) # Index is the index used to generate address.(deterministic key generation)
-	else:
-		# Index is a large random number that combines with the master public key to yield the address. This combination takes constant time -- it doesn't hurt us to use a very large index. An attacker which knows index, mpk, address, and the _private_ key for address can get the private key for _any_ public key generated using mpk. To limit the damage if one private key gets leaked, we'll make index cryptographically securely random, even though it's probably unnecessary.
-		index = random.SystemRandom().getrandbits(128)
-		address = bitcoin.electrum_address(mpk, index)
-		# Price is the price to buy a bond, in satoshi. (We don't use BTC because we don't want floating point errors.)
-		price = global_storage.bond_price
-		SellerDB.put(token=token, index=index, address=address, price=price)
-	return (address, price)
+	if dbentry is not None:
+		return (dbentry['address'], dbentry['price'])
+
+	# Index is a large random number that combines with the master public key to yield the address. This combination takes constant time -- it doesn't hurt us to use a very large index. An attacker which knows index, mpk, address, and the _private_ key for address can get the private key for _any_ public key generated using mpk. To limit the damage if one private key gets leaked, we'll make index cryptographically securely random, even though it's probably unnecessary.
+	index = random.SystemRandom().getrandbits(128)
+	address = bitcoin.electrum_address(mpk, index)
+	# Price is the price to buy a bond, in satoshi. (We don't use BTC because we don't want floating point errors.)
+	price = global_storage.bond_price
+	# If another quote for the same token got in first, this returns its entry instead, and our index goes unused.
+	dbentry = SellerDB.get_or_create(token=token, index=index, address=address, price=price)
+	return (dbentry['address'], dbentry['price'])
 
 def sanetoken(token):
 	"""
@@ -2,45 +2,129 @@
 rpc_servers.RedeemerDB
 """
 
-import rpc_lib, sqlite3, time
+import rpc_lib, db_lib, sqlite3, struct, time
 
 rpc_lib.set_rpc_socket_path("rpc/RedeemerDB/sock")
 
-@rpc_lib.expose_rpc
-def try_to_redeem(bond, address):
-	conn = sqlite3.connect("data/redeemer_database/redeemer_database.db")
+db = db_lib.Database("data/redeemer_database/redeemer_database.db")
+
+# The size of the Bloom filter of spent bonds, and how many bits each bond sets. 2**23 bits is 1 MB, and keeps
+# false positives to about 1% up to 800,000 bonds.
+BLOOM_BITS = 2**23
+BLOOM_HASHES = 7
+# Rows read at a time when filling the filter at startup.
+BLOOM_LOAD_BATCH = 10000
+
+class BloomFilter:
+	# A set of digests that can say for sure that a digest is not in it, but only probably that it is.
+	# Digests are already uniformly random, so the bit positions are just taken from their bytes.
+	def __init__(self, bits=BLOOM_BITS, hashes=BLOOM_HASHES):
+		assert hashes <= 8
+		self.bits, self.hashes = bits, hashes
+		self.array = bytearray(bits / 8)
+
+	def positions(self, digest):
+		return [position % self.bits for position in struct.unpack(">8I", str(digest))[:self.hashes]]
+
+	def add(self, digest):
+		for position in self.positions(digest):
+			self.array[position / 8] |= 1 << (position % 8)
+
+	def __contains__(self, digest):
+		return all(self.array[position / 8] & (1 << (position % 8)) for position in self.positions(digest))
+
+def load_spent():
+	spent = BloomFilter()
+	after = None
+	while True:
+		rows = db.read("select rowid, digest from transactions where rowid > ? order by rowid limit ?", (after or 0, BLOOM_LOAD_BATCH))
+		for row in rows:
+			spent.add(row["digest"])
+		if len(rows) < BLOOM_LOAD_BATCH:
+			return spent
+		after = rows[-1]["rowid"]
+
+# Almost every bond being redeemed is fresh, and the filter lets those go straight to the insert.
+# The primary key is what actually stops double spending, the filter only saves looking first.
+spent = load_spent()
+
+def redeem(conn, (bond, address)):
+	digest = db_lib.bond_digest(bond)
+	if digest in spent and list(conn.execute("select 1 from transactions where digest = ?", (digest,))):
+		return False
 	try:
-		row = (bond.encode("hex"), address, 0)
-		conn.execute("insert into transactions(bond, address, fulfilled) values(?, ?, ?)", row)
-		conn.commit()
-		return True
+		conn.execute("insert into transactions(digest, bond, address, fulfilled, state) values(?, ?, ?, ?, 'unfulfilled')", (digest, db_lib.blob(bond), address, 0))
 	except sqlite3.IntegrityError:
 		# This means the row is already in the database, and we report this by returning False.
 		return False
-	finally:
-		conn.close()
+	spent.add(digest)
+	return True
+
+# Redemptions come in bursts, so rather than a commit each, the ones that arrive together share a transaction.
+# Each call still only returns once its row has been committed.
+redemptions = db_lib.GroupCommit(db, redeem)
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def try_to_redeem(bond, address):
+	return redemptions.submit((bond, address))
+
+@rpc_lib.expose_rpc_batch(try_to_redeem)
+def try_to_redeem_batch(calls):
+	outcomes = redemptions.submit_many([(call["bond"], call["address"]) for call in calls])
+	# A bond that failed fails only its own call in the batch, and the others still get their outcomes.
+	for i, outcome in enumerate(outcomes):
+		if isinstance(outcome, Exception) and not isinstance(outcome, rpc_lib.RPCException):
+			outcomes[i] = rpc_lib.RPCException(str(outcome))
+	return outcomes
 
 @rpc_lib.expose_rpc
 def mark_fulfilled(bond):
-	conn = sqlite3.connect("data/redeemer_database/redeemer_database.db")
-	bond = bond.encode("hex")
-	try:
-		conn.execute("update transactions set fulfilled = 1 where bond = ?", (bond,))
-		conn.commit()
-	finally:
-		conn.close()
+	with db.transaction() as conn:
+		conn.execute("update transactions set fulfilled = 1, state = 'fulfilled' where digest = ?", (db_lib.bond_digest(bond),))
 	return True
 
+@rpc_lib.expose_rpc_batch(mark_fulfilled)
+def mark_fulfilled_batch(calls):
+	# Mark every bond in one transaction, instead of one commit per bond.
+	with db.transaction() as conn:
+		conn.executemany("update transactions set fulfilled = 1, state = 'fulfilled' where digest = ?", [(db_lib.bond_digest(call["bond"]),) for call in calls])
+	return [True] * len(calls)
+
+def decode_rows(rows):
+	rows = map(dict, rows)
+	for row in rows:
+		del row["digest"]
+		row["bond"] = str(row["bond"])
+	return rows
+
+# The Dispenser's work queue. It claims a batch of unfulfilled rows, and marks each one fulfilled once it has sent
+# the bitcoins. A claimed row is never handed out again, even if the Dispenser dies before marking it, because we
+# can't know whether the bitcoins went out: rows left in the dispensing state need looking into by hand.
+# See setup_databases.py for the states a row goes through.
 @rpc_lib.expose_rpc
+def claim_unfulfilled(limit):
+	with db.transaction() as conn:
+		rows = list(conn.execute("select rowid, * from transactions where state = 'unfulfilled' order by rowid limit ?", (limit,)))
+		conn.executemany("update transactions set state = 'dispensing' where rowid = ?", [(row["rowid"],) for row in rows])
+	rows = decode_rows(rows)
+	for row in rows:
+		del row["rowid"]
+		row["state"] = "dispensing"
+	return rows
+
+# This is a read, and reads have connections of their own from the database's pool, so it doesn't need the global lock.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def get_unfulfilled_rows():
-	conn = sqlite3.connect("data/redeemer_database/redeemer_database.db")
-	conn.row_factory = sqlite3.Row
-	try:
-		cursor = conn.execute("select * from transactions where fulfilled = 0")
-		rows = map(dict, cursor)
-		for row in rows:
-			row["bond"] = row["bond"].decode("hex")
-		return rows
-	finally:
-		conn.close()
+	# This returns every row at once, so prefer get_unfulfilled_rows_page for anything big.
+	return decode_rows(db.read("select * from transactions where state = 'unfulfilled'"))
 
+# Paginated by rowid (see rpc_lib.make_page).
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def get_unfulfilled_rows_page(after=None, limit=rpc_lib.MAX_PAGE_SIZE):
+	limit = rpc_lib.page_size(limit)
+	rows = db.read("select rowid, * from transactions where state = 'unfulfilled' and rowid > ? order by rowid limit ?", (after or 0, limit))
+	cursor = rows[-1]["rowid"] if rows else None
+	rows = decode_rows(rows)
+	for row in rows:
+		del row["rowid"]
+	return rpc_lib.make_page(rows, limit, cursor)
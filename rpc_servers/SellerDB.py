@@ -2,63 +2,264 @@
 rpc_servers.SellerDB
 """
 
-import rpc_lib, sqlite3, time
+import rpc_lib, db_lib, cache_lib, sqlite3, time
 
 rpc_lib.set_rpc_socket_path("rpc/SellerDB/sock")
 
-@rpc_lib.expose_rpc
+# The rows are split between shards by token (see db_lib.open_shards), and each shard has its own write lock.
+# Reads each take a connection of their own from a shard's pool, and WAL mode lets them run alongside the writes,
+# so none of the methods need the global lock: writes to different shards run at the same time.
+shards = db_lib.open_shards("data/seller_database/seller_database.db")
+for db in shards:
+	db.attach("data/seller_database/seller_archive.db", "archive")
+
+def shard(token):
+	return shards[db_lib.shard_of(token, len(shards))]
+
+# Clients poll get for the same few tokens over and over, so the rows it returns are cached, by token.
+# Anything that changes what get would return for a token invalidates it, once the change is committed.
+ROW_CACHE_SIZE = 10000
+rows_by_token = cache_lib.LRUCache(ROW_CACHE_SIZE)
+rpc_lib.register_stats("row_cache", rows_by_token.stats)
+
+# A claim by the Collector that is this old (in seconds) is taken to have been abandoned, say because the Collector
+# crashed, and the row goes back in the queue. Sweeping an address twice is harmless: the second sweep finds it empty.
+CLAIM_TIMEOUT = 600
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def get(token):
-	conn = sqlite3.connect("data/seller_database/seller_database.db")
-	conn.row_factory = sqlite3.Row
-	token = token.encode("hex")
-	try:
-		rows = list(conn.execute("select address_index, address, price, timestamp, protobond_sent from transactions where token=?", (token,)))
-		assert len(rows) <= 1
-		if len(rows) == 0:
-			return None
-		row = dict(rows[0])
-		row["address_index"] = int(row["address_index"])
-		row["address"] = row["address"].decode("hex")
-		return row
-	finally:
-		conn.close()
+	row = rows_by_token.get(token)
+	if row is not cache_lib.MISSING:
+		return dict(row)
+	version = rows_by_token.version()
+	rows = shard(token).read("select address_index, address, price, timestamp, protobond_sent, protobond, state from transactions where token in (?, ?)", db_lib.keys(token))
+	assert len(rows) <= 1
+	if len(rows) == 0:
+		return None
+	row = decode_rows(rows)[0]
+	rows_by_token.put(token, row, version)
+	return dict(row)
 
-@rpc_lib.expose_rpc
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def put(token, index, address, price):
-	conn = sqlite3.connect("data/seller_database/seller_database.db")
-	try:
-		row = (token.encode("hex"), str(index), address.encode("hex"), price, time.time(), 0)
+	row = (db_lib.blob(token), db_lib.encode_index(index), db_lib.blob(address), price, time.time(), 0)
+	with shard(token).transaction() as conn:
+		# The primary key can't catch a duplicate of a row that is still in the old format.
+		if list(conn.execute("select 1 from transactions where token = ?", (token.encode("hex"),))):
+			raise sqlite3.IntegrityError("Token already in database.")
 		# This next line might throw sqlite3.IntegrityError, but that's okay.
 		conn.execute("insert into transactions(token, address_index, address, price, timestamp, protobond_sent) values(?, ?, ?, ?, ?, ?)", row)
-		conn.commit()
-		return True
-	finally:
-		conn.close()
+	return True
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def get_or_create(token, index, address, price):
+	# Returns the row for token, like get, first putting in a new one with the given values if there isn't one.
+	# It is all one transaction, so calls for the same token at the same time all get the same row.
+	version = rows_by_token.version()
+	with shard(token).transaction() as conn:
+		rows = list(conn.execute("select address_index, address, price, timestamp, protobond_sent, protobond, state from transactions where token in (?, ?)", db_lib.keys(token)))
+		if rows:
+			row = decode_rows(rows)[0]
+		else:
+			row = {"address_index": index, "address": address, "price": price, "timestamp": time.time(), "protobond_sent": 0, "protobond": None, "paid": False}
+			conn.execute("insert into transactions(token, address_index, address, price, timestamp, protobond_sent) values(?, ?, ?, ?, ?, ?)",
+				(db_lib.blob(token), db_lib.encode_index(index), db_lib.blob(address), price, row["timestamp"], 0))
+	rows_by_token.put(token, row, version)
+	return dict(row)
 
-@rpc_lib.expose_rpc
-def mark_protobond_sent(token):
-	conn = sqlite3.connect("data/seller_database/seller_database.db")
-	token = token.encode("hex")
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def mark_protobond_sent(token, protobond=None):
+	# Given the protobond, this keeps it in the row, and get returns it from then on, so that the token
+	# doesn't have to be checked and signed all over again when the client asks for it again.
 	try:
-		try:
-			conn.execute("update transactions set protobond_sent = protobond_sent + 1 where token = ?", (token,))
-		except sqlite3.IntegrityError:
-			return False
-		conn.commit()
-		return True
+		with shard(token).transaction() as conn:
+			# The address has been paid, so it can now be swept by the Collector.
+			conn.execute("update transactions set protobond_sent = protobond_sent + 1, protobond = coalesce(?, protobond), state = case when state in ('quoted', 'underpaid') then 'pending' else state end where token in (?, ?)",
+				(protobond,) + db_lib.keys(token))
+	except sqlite3.IntegrityError:
+		return False
 	finally:
-		conn.close()
+		rows_by_token.invalidate(token)
+	return True
+
+def decode_rows(rows):
+	rows = map(dict, rows)
+	for row in rows:
+		row["address_index"] = db_lib.decode_index(row["address_index"])
+		row["address"] = db_lib.unblob(row["address"])
+		if row.get("protobond") is not None:
+			row["protobond"] = str(row["protobond"])
+		# Rows that have gone on from being quoted are known to have been paid (see mark_paid), unless they were
+		# underpaid. Only this much of the state is given out, as it is all that get's cache is kept up to date on.
+		if "state" in row:
+			row["paid"] = row.pop("state") not in ("quoted", "underpaid")
+	return rows
+
+# The Collector's work queue. It claims a batch of paid addresses, sweeps them, and marks each one collected,
+# or releases it back into the queue if it couldn't be swept this time.
+# See setup_databases.py for the states a row goes through.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def claim_pending_collection(limit):
+	# Takes rows from each shard in turn until there are limit of them.
+	now = time.time()
+	claimed = []
+	for db in shards:
+		with db.transaction() as conn:
+			conn.execute("update transactions set state = 'pending' where state = 'collecting' and claimed_at < ?", (now - CLAIM_TIMEOUT,))
+			rows = list(conn.execute("select rowid, address_index, address, price, timestamp from transactions where state = 'pending' order by rowid limit ?", (limit - len(claimed),)))
+			conn.executemany("update transactions set state = 'collecting', claimed_at = ? where rowid = ?", [(now, row["rowid"]) for row in rows])
+		claimed += rows
+		if len(claimed) >= limit:
+			break
+	rows = decode_rows(claimed)
+	for row in rows:
+		del row["rowid"]
+	return rows
 
-@rpc_lib.expose_rpc
+# These are by address, which doesn't say which shard the row is in, so they look in all of them. Each one is
+# a single lookup on the address index, and there aren't many shards.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def mark_collected(address):
+	for db in shards:
+		with db.transaction() as conn:
+			conn.execute("update transactions set state = 'collected', claimed_at = null where address in (?, ?) and state = 'collecting'", db_lib.keys(address))
+	return True
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def release_collection(address):
+	for db in shards:
+		with db.transaction() as conn:
+			conn.execute("update transactions set state = 'pending', claimed_at = null where address in (?, ?) and state = 'collecting'", db_lib.keys(address))
+	return True
+
+# Retention. Quotes that are never paid, and sales that are finished with, are moved out to the archive database
+# (see setup_databases.py), so that the table the services work on only holds the rows still in use.
+# How long a quote stays open, and how long a row is kept after its sale is finished, in seconds.
+# The ages are counted from when the quote was given. A client can still fetch its protobond until its row is archived.
+QUOTE_TTL = 24 * 3600
+ARCHIVE_AFTER = 7 * 24 * 3600
+# Rows moved per call.
+RETENTION_BATCH = 1000
+
+# A client may pay and then stay away for longer than QUOTE_TTL, so an old quote can't just be thrown away.
+# The Collector pages through them with this, looks up the balance of each address, and then hands the ones that
+# were paid to mark_paid, the ones with nothing in them to expire_quotes, and the ones paid in part to mark_underpaid.
+# Paginated by shard, then rowid, like get_rows_with_protobond_sent_page.
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def get_expired_quotes_page(quote_ttl=QUOTE_TTL, after=None, limit=rpc_lib.MAX_PAGE_SIZE):
+	limit = rpc_lib.page_size(limit)
+	before = time.time() - quote_ttl
+	first, after_rowid = after or (0, 0)
+	page, cursor = [], None
+	for i in range(first, len(shards)):
+		rows = shards[i].read("select rowid, address_index, address, price from transactions where state = 'quoted' and timestamp < ? and rowid > ? order by rowid limit ?",
+			(before, after_rowid if i == first else 0, limit - len(page)))
+		if rows:
+			page += rows
+			cursor = [i, rows[-1]["rowid"]]
+		if len(page) >= limit:
+			break
+	rows = decode_rows(page)
+	for row in rows:
+		del row["rowid"]
+	return rpc_lib.make_page(rows, limit, cursor)
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def mark_paid(addresses):
+	# Moves the quotes for these addresses, which the Collector found paid, into its queue to be swept.
+	# IssueProtobond sees that they are paid from the row, as the address will be empty once it is swept.
+	# Returns how many rows were changed.
+	tokens = []
+	for db in shards:
+		with db.transaction() as conn:
+			for address in addresses:
+				rows = list(conn.execute("select rowid, token from transactions where address in (?, ?) and state = 'quoted'", db_lib.keys(address)))
+				conn.executemany("update transactions set state = 'pending' where rowid = ?", [(row["rowid"],) for row in rows])
+				tokens += [db_lib.unblob(row["token"]) for row in rows]
+	for token in tokens:
+		rows_by_token.invalidate(token)
+	return len(tokens)
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def mark_underpaid(addresses, quote_ttl=QUOTE_TTL):
+	# Takes the quotes for these addresses, which the Collector found paid in part, out of get_expired_quotes_page,
+	# so they aren't looked up again every cycle. They stay in the table, to be handled by hand (see setup_databases.py).
+	# get still says they aren't paid, so the cached rows stay good. Returns how many rows were changed.
+	now = time.time()
+	changed = 0
+	for db in shards:
+		with db.transaction() as conn:
+			for address in addresses:
+				changed += conn.execute("update transactions set state = 'underpaid' where address in (?, ?) and state = 'quoted' and timestamp < ?",
+					db_lib.keys(address) + (now - quote_ttl,)).rowcount
+	return changed
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def expire_quotes(addresses, quote_ttl=QUOTE_TTL):
+	# Archives the quotes for these addresses, which the Collector found empty, if they are still unpaid and
+	# older than quote_ttl. Returns how many rows were moved.
+	now = time.time()
+	expired = []
+	for db in shards:
+		with db.transaction() as conn:
+			rows = []
+			for address in addresses:
+				rows += conn.execute("select rowid, token from transactions where address in (?, ?) and state = 'quoted' and timestamp < ?",
+					db_lib.keys(address) + (now - quote_ttl,))
+			expired += archive_rows(conn, rows, "expired", now)
+	for token in expired:
+		rows_by_token.invalidate(token)
+	return len(expired)
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def archive_collected(archive_after=ARCHIVE_AFTER, limit=RETENTION_BATCH):
+	# Moves up to limit collected rows, and returns how many it moved. Call it until that is under limit to
+	# clear the whole backlog.
+	now = time.time()
+	archived = []
+	for db in shards:
+		with db.transaction() as conn:
+			rows = list(conn.execute("select rowid, token from transactions where state = 'collected' and timestamp < ? order by timestamp limit ?",
+				(now - archive_after, limit - len(archived))))
+			archived += archive_rows(conn, rows, "collected", now)
+	for token in archived:
+		rows_by_token.invalidate(token)
+	return len(archived)
+
+def archive_rows(conn, rows, new_state, now):
+	# Moves the given rows, which have rowid and token, and returns their tokens.
+	rowids = [(row["rowid"],) for row in rows]
+	# The two databases are committed one after the other, not atomically, so if we die in between, the rows are
+	# still here, and get archived again next time: hence the "or replace".
+	conn.executemany("""insert or replace into archive.transactions(token, address_index, address, price, timestamp, protobond_sent, protobond, state, claimed_at, archived_at)
+		select token, address_index, address, price, timestamp, protobond_sent, protobond, ?, claimed_at, ? from transactions where rowid = ?""",
+		[(new_state, now) + rowid for rowid in rowids])
+	conn.executemany("delete from transactions where rowid = ?", rowids)
+	return [db_lib.unblob(row["token"]) for row in rows]
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
 def get_rows_with_protobond_sent():
-	conn = sqlite3.connect("data/seller_database/seller_database.db")
-	conn.row_factory = sqlite3.Row
-	try:
-		rows = map(dict, conn.execute("select address_index, address, price, timestamp, protobond_sent from transactions where protobond_sent > 0",))
-		for row in rows:
-			row["address_index"] = int(row["address_index"])
-			row["address"] = row["address"].decode("hex")
-		return rows
-	finally:
-		conn.close()
+	# This returns every row at once, so prefer get_rows_with_protobond_sent_page for anything big.
+	rows = []
+	for db in shards:
+		rows += db.read("select address_index, address, price, timestamp, protobond_sent from transactions where protobond_sent > 0")
+	return decode_rows(rows)
 
+# Paginated by shard, then rowid: the cursor is [shard, rowid] (see rpc_lib.make_page).
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def get_rows_with_protobond_sent_page(after=None, limit=rpc_lib.MAX_PAGE_SIZE):
+	limit = rpc_lib.page_size(limit)
+	first, after_rowid = after or (0, 0)
+	page, cursor = [], None
+	for i in range(first, len(shards)):
+		rows = shards[i].read("select rowid, address_index, address, price, timestamp, protobond_sent from transactions where protobond_sent > 0 and rowid > ? order by rowid limit ?",
+			(after_rowid if i == first else 0, limit - len(page)))
+		if rows:
+			page += rows
+			cursor = [i, rows[-1]["rowid"]]
+		if len(page) >= limit:
+			break
+	rows = decode_rows(page)
+	for row in rows:
+		del row["rowid"]
+	return rpc_lib.make_page(rows, limit, cursor)
@@ -6,19 +6,26 @@ It is vital to the security of our system that Sign.sign be deterministic.
 
 import base64
 import global_storage
-import rpc_lib
+import rpc_lib, bignum
 
 rpc_lib.set_rpc_socket_path("rpc/Sign/sock")
 
+# Sign runs as several prefork workers (see permissions.py), so it keeps nothing in memory but the key.
+# A token that comes back for its protobond gets it from the seller row (see SellerDB.mark_protobond_sent),
+# without reaching us at all.
+
+@global_storage.memoized
+def get_signer():
+	# Precomputes the CRT values for the key, and checks them, so this is done once per process.
+	return bignum.PrivateKey.from_pycrypto(global_storage.get_signing_private_key())
+
 @rpc_lib.expose_rpc
 def sign(token):
 	"""
 	Signs the token to create the protobond.
 	PROTOBOND = (m * r^e)^d = (m^d * r^e^d) = (m^d * r) mod n
 	"""
-	key = global_storage.get_signing_private_key()
-	protobond = key.decrypt(longDecode(token))
-	return longEncode(protobond)
+	return longEncode(get_signer().decrypt(longDecode(token)))
 
 def longEncode(n):
 	"""
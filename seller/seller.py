@@ -18,6 +18,9 @@ app = Flask(__name__)
 # Restrict uploading files larger than 10kB.
 # Tokens are ~1kB, but this prevents cat GIF uploads.
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024
+# Give up on the RPCs behind a request after this many seconds, rather than letting requests pile up
+# behind a stalled service. Every service along the way gives up at the same time.
+REQUEST_TIMEOUT = 30
 
 @app.route('/')
 @app.route('/index')
@@ -40,15 +43,22 @@ def fetch_connect():
 @app.route('/quote', methods=['POST'])
 def fetch_quote():
 	token = request.form.get('token', None)
-	(addr, price) = GenQuote.gen_quote(token=token)
+	with rpc_lib.deadline(REQUEST_TIMEOUT):
+		(addr, price) = GenQuote.gen_quote(token=token)
 	return jsonify(token=token, addr=addr, price=price)
 
 @app.route('/protobond', methods=['POST'])
 def fetch_protobond():
 	token = request.form.get('token', None)
-	protobond = IssueProtobond.issue_protobond(token=token)
+	with rpc_lib.deadline(REQUEST_TIMEOUT):
+		protobond = IssueProtobond.issue_protobond(token=token)
 	return jsonify(protobond=protobond)
 
+@app.errorhandler(rpc_lib.RPCTimeout)
+def rpc_lib_RPCTimeout(error):
+	print traceback.format_exc()
+	return 'The server is too busy right now, please try again later.', 503
+
 @app.errorhandler(rpc_lib.RPCException)
 def rpc_lib_RPCException(error):
 	print traceback.format_exc()
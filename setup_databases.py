@@ -3,50 +3,310 @@
 setup_databases.py
 """
 
-import sys, os, sqlite3
+import sys, os, time, sqlite3
 
-if len(sys.argv) != 2:
-	print "Usage: %s <jail root>"
+import db_lib
+
+def usage():
+	print "Usage: %s [--upgrade | --migrate | --reshard <count>] <jail root>" % sys.argv[0]
 	print
 	print "Sets up the databases in the jail directory."
 	print "WARNING: Overwrites whatever database you currently have!"
+	print
+	print "With --upgrade, instead brings existing databases up to date with the current schema, keeping their rows."
+	print "Only run this while the database services are stopped."
+	print
+	print "With --migrate, converts seller rows stored in the old hex format to BLOBs (see db_lib.py), a batch at a time."
+	print "This one is safe to run while the database services are up, and to stop and run again."
+	print
+	print "With --reshard, splits the seller database into count shards (see db_lib.py), moving rows between them."
+	print "Only run this while SellerDB is stopped. It is safe to run again if it is interrupted."
 	exit(1)
 
-jail_dir = sys.argv[1]
-
-seller_db_path = jail_dir + "/dryer21/data/seller_database/seller_database.db"
-redeemer_db_path = jail_dir + "/dryer21/data/redeemer_database/redeemer_database.db"
-
-try:
-	os.unlink(seller_db_path)
-	os.unlink(redeemer_db_path)
-except OSError:
-	pass
-
-# Create the seller database.
-con = sqlite3.connect(seller_db_path)
-con.execute("""
+# The state of each seller row, for the Collector's work queue:
+#   quoted: we gave out the address, but haven't issued a protobond for it.
+#   pending: the address has been paid, and is waiting to be swept. Normally that is when we issue the protobond,
+#     but the Collector also finds paid quotes that were never picked up, before it expires them.
+#   collecting: the Collector has claimed the row (at claimed_at), and is sweeping it.
+#   collected: the address has been swept.
+#   underpaid: the quote ran out with some money paid to the address, but not enough. The Collector leaves these
+#     for someone to sort out by hand, but if the client pays the rest and asks for its protobond, the row goes
+#     on to pending like any other.
+# And of each redeemer row, for the Dispenser's:
+#   unfulfilled: the bond was redeemed, but nothing has been sent yet.
+#   dispensing: the Dispenser has claimed the row, and is sending the bitcoins.
+#   fulfilled: the bitcoins were sent.
+# The partial indexes only hold the rows in the states that are waiting on work, so that the Collector and
+# the Dispenser find their work in time proportional to how much there is, rather than to all of history.
+seller_schema = """
 create table transactions (
-	token text primary key,
-	address_index text,
-	address text,
+	token blob primary key,
+	address_index blob,
+	address blob,
 	price integer,
 	timestamp real,
-	protobond_sent integer
+	protobond_sent integer,
+	state text not null default 'quoted',
+	claimed_at real,
+	protobond text
 );
-""")
-con.commit()
-con.close()
+"""
+seller_indexes = """
+create index if not exists transactions_pending on transactions(state) where state = 'pending';
+create index if not exists transactions_collecting on transactions(claimed_at) where state = 'collecting';
+create index if not exists transactions_address on transactions(address);
+create index if not exists transactions_timestamp on transactions(state, timestamp);
+"""
+
+# Where SellerDB.expire_quotes and SellerDB.archive_collected move old rows to. A row's state there is expired for a
+# quote that was never paid, or collected. The archive is never read by the services, it is for auditing, for sweeping
+# by hand any address that gets paid after its quote expired, and for finding the protobond of a client that comes
+# back after its row was archived.
+seller_archive_schema = """
+create table if not exists transactions (
+	token blob primary key,
+	address_index blob,
+	address blob,
+	price integer,
+	timestamp real,
+	protobond_sent integer,
+	state text,
+	claimed_at real,
+	archived_at real,
+	protobond text
+);
+create index if not exists transactions_address on transactions(address);
+"""
 
-# Create the redeemer database.
-con = sqlite3.connect(redeemer_db_path)
-con.execute("""
+redeemer_schema = """
 create table transactions (
-	bond text primary key,
+	digest blob primary key,
+	bond blob,
 	address text,
-	fulfilled integer
+	fulfilled integer,
+	state text not null default 'unfulfilled'
 );
-""")
-con.commit()
-con.close()
+"""
+redeemer_indexes = """
+create index if not exists transactions_unfulfilled on transactions(state) where state = 'unfulfilled';
+create index if not exists transactions_dispensing on transactions(state) where state = 'dispensing';
+"""
+
+def remove(path):
+	# Along with the files sqlite3 keeps next to it in WAL mode.
+	for name in (path, path + "-wal", path + "-shm"):
+		try:
+			os.unlink(name)
+		except OSError:
+			pass
+
+def create(path, schema, indexes=""):
+	remove(path)
+	con = sqlite3.connect(path)
+	con.executescript(schema + indexes)
+	con.commit()
+	con.close()
+
+def add_column(con, column, definition):
+	# Returns whether the column was missing.
+	if column in [row[1] for row in con.execute("pragma table_info(transactions)")]:
+		return False
+	con.execute("alter table transactions add column %s %s" % (column, definition))
+	return True
+
+def upgrade_seller(path):
+	con = sqlite3.connect(path)
+	if add_column(con, "state", "text not null default 'quoted'"):
+		# We don't know which addresses were swept before there was a state, so they all get checked once more.
+		con.execute("update transactions set state = 'pending' where protobond_sent > 0")
+	add_column(con, "claimed_at", "real")
+	add_column(con, "protobond", "text")
+	con.executescript(seller_indexes)
+	con.commit()
+	con.close()
+
+def upgrade_seller_shards(path):
+	con = sqlite3.connect(path)
+	count = db_lib.shard_count(con)
+	con.close()
+	for shard in range(count):
+		upgrade_seller(db_lib.shard_path(path, shard))
+
+def upgrade_seller_archive(path):
+	con = sqlite3.connect(path)
+	con.executescript(seller_archive_schema)
+	add_column(con, "protobond", "text")
+	con.commit()
+	con.close()
+
+def upgrade_redeemer(path):
+	con = sqlite3.connect(path)
+	if add_column(con, "state", "text not null default 'unfulfilled'"):
+		con.execute("update transactions set state = 'fulfilled' where fulfilled = 1")
+	con.commit()
+	if "digest" not in [row[1] for row in con.execute("pragma table_info(transactions)")]:
+		rebuild_redeemer(con)
+	con.executescript(redeemer_indexes)
+	con.commit()
+	con.close()
+
+def rebuild_redeemer(con):
+	# Rows used to be keyed by the bond itself, so the table is copied into a new one keyed by digest,
+	# converting bonds stored in the old hex format on the way. This is all one transaction, so that if it
+	# is interrupted, the old table is left as it was.
+	con.isolation_level = None
+	con.execute("begin")
+	con.execute(redeemer_schema.replace("create table transactions", "create table new_transactions"))
+	# The same bond can be in the old table more than once, e.g. as hex and as a BLOB, or written two ways (see
+	# db_lib.bond_digest). Only one row per digest is kept: the first that may have been paid out, or else the first.
+	kept, order = {}, []
+	for bond, address, fulfilled, state in con.execute("select bond, address, fulfilled, state from transactions order by rowid").fetchall():
+		if not isinstance(bond, buffer):
+			bond = bond.decode("hex")
+		bond = str(bond)
+		row = (db_lib.bond_digest(bond), db_lib.blob(bond), address, fulfilled, state)
+		digest = str(row[0])
+		if digest not in kept:
+			kept[digest] = row
+			order.append(digest)
+			continue
+		if payout_rank(row) > payout_rank(kept[digest]):
+			row, kept[digest] = kept[digest], row
+		print "Dropping a duplicate redeemer row for bond %s..., to address %r (fulfilled=%r, state=%r)." % (bond[:16], row[2], row[3], row[4])
+	con.executemany("insert into new_transactions(digest, bond, address, fulfilled, state) values(?, ?, ?, ?, ?)",
+		[kept[digest] for digest in order])
+	# The old table's indexes go with it, so the new ones can be made with the same names.
+	con.execute("drop table transactions")
+	con.execute("alter table new_transactions rename to transactions")
+	con.execute("commit")
+	con.isolation_level = ""
+
+def payout_rank(row):
+	# How far row, as inserted by rebuild_redeemer, is along the way to having its bitcoins sent.
+	fulfilled, state = row[3], row[4]
+	if fulfilled or state == "fulfilled":
+		return 2
+	return 1 if state == "dispensing" else 0
+
+# Rows converted per transaction by --migrate, and the pause between transactions, in seconds, which lets
+# the services' own writes in.
+MIGRATE_BATCH = 1000
+MIGRATE_PAUSE = 0.05
+
+def migrate(path, convert):
+	# convert(row) returns the new values for the row's byte string columns, or None if it is already converted.
+	# Columns declared as text keep BLOBs as they are, so there is no need to rebuild the table.
+	con = sqlite3.connect(path, timeout=db_lib.BUSY_TIMEOUT)
+	con.row_factory = sqlite3.Row
+	after, converted = 0, 0
+	while True:
+		with con:
+			rows = list(con.execute("select rowid, * from transactions where rowid > ? order by rowid limit ?", (after, MIGRATE_BATCH)))
+			for row in rows:
+				update = convert(row)
+				if update is not None:
+					con.execute("update transactions set %s where rowid = ?" % ", ".join("%s = ?" % column for column in update),
+						update.values() + [row["rowid"]])
+					converted += 1
+		if len(rows) < MIGRATE_BATCH:
+			break
+		after = rows[-1]["rowid"]
+		time.sleep(MIGRATE_PAUSE)
+	con.close()
+	print "%s: converted %i rows." % (path, converted)
+
+def shard_files(path):
+	# How many shard files there are, which can be more than the shard count if a --reshard was interrupted.
+	files = 1
+	while os.path.exists(db_lib.shard_path(path, files)):
+		files += 1
+	return files
+
+def reshard(path, count):
+	first = sqlite3.connect(path)
+	files = max(shard_files(path), count)
+	cons = [first] + [sqlite3.connect(db_lib.shard_path(path, shard)) for shard in range(1, files)]
+	for con in cons:
+		con.row_factory = sqlite3.Row
+		if not list(con.execute("select 1 from sqlite_master where name = 'transactions'")):
+			con.executescript(seller_schema)
+		con.executescript(seller_indexes)
+		con.commit()
+	# Each row is committed to its new shard before it is deleted from its old one, so if this is interrupted,
+	# a row may be in both, and running it again finishes the job.
+	moved = 0
+	for shard, con in enumerate(cons):
+		after = 0
+		while True:
+			rows = con.execute("select rowid, * from transactions where rowid > ? order by rowid limit ?", (after, MIGRATE_BATCH)).fetchall()
+			moving = [(row, db_lib.shard_of(db_lib.unblob(row["token"]), count)) for row in rows]
+			moving = [(row, target) for row, target in moving if target != shard]
+			for row, target in moving:
+				columns = row.keys()[1:]
+				cons[target].execute("insert or replace into transactions(%s) values(%s)" % (", ".join(columns), ", ".join("?" * len(columns))), tuple(row)[1:])
+			for target in cons:
+				target.commit()
+			con.executemany("delete from transactions where rowid = ?", [(row["rowid"],) for row, target in moving])
+			con.commit()
+			moved += len(moving)
+			if len(rows) < MIGRATE_BATCH:
+				break
+			after = rows[-1]["rowid"]
+	first.execute("create table if not exists shards (count integer)")
+	first.execute("delete from shards")
+	first.execute("insert into shards (count) values (?)", (count,))
+	first.commit()
+	for con in cons:
+		con.close()
+	# The shards past the new count are empty now.
+	for shard in range(count, files):
+		remove(db_lib.shard_path(path, shard))
+	print "%s: moved %i rows, into %i shards." % (path, moved, count)
+
+def convert_seller(row):
+	if isinstance(row["token"], buffer):
+		return None
+	return {
+		"token": db_lib.blob(row["token"].decode("hex")),
+		"address_index": db_lib.encode_index(int(row["address_index"])),
+		"address": db_lib.blob(row["address"].decode("hex")),
+	}
+
+if __name__ == "__main__":
+	arguments = sys.argv[1:]
+	mode = None
+	if arguments[:1] in (["--upgrade"], ["--migrate"], ["--reshard"]):
+		mode = arguments.pop(0)
+	if mode == "--reshard":
+		if len(arguments) != 2 or not arguments[0].isdigit() or int(arguments[0]) < 1:
+			usage()
+		shards = int(arguments.pop(0))
+	if len(arguments) != 1:
+		usage()
+
+	jail_dir = arguments[0]
+
+	seller_db_path = jail_dir + "/dryer21/data/seller_database/seller_database.db"
+	seller_archive_path = jail_dir + "/dryer21/data/seller_database/seller_archive.db"
+	redeemer_db_path = jail_dir + "/dryer21/data/redeemer_database/redeemer_database.db"
 
+	if mode == "--upgrade":
+		upgrade_seller_shards(seller_db_path)
+		upgrade_seller_archive(seller_archive_path)
+		upgrade_redeemer(redeemer_db_path)
+	elif mode == "--migrate":
+		con = sqlite3.connect(seller_db_path)
+		count = db_lib.shard_count(con)
+		con.close()
+		for shard in range(count):
+			migrate(db_lib.shard_path(seller_db_path, shard), convert_seller)
+	elif mode == "--reshard":
+		reshard(seller_db_path, shards)
+	else:
+		# Create the seller database, in one shard, and get rid of any other shards from before.
+		create(seller_db_path, seller_schema, seller_indexes)
+		for shard in range(1, shard_files(seller_db_path)):
+			remove(db_lib.shard_path(seller_db_path, shard))
+		create(seller_archive_path, seller_archive_schema)
+		# Create the redeemer database.
+		create(redeemer_db_path, redeemer_schema, redeemer_indexes)
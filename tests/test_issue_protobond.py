@@ -0,0 +1,54 @@
+"""
+Tests for rpc_servers/IssueProtobond.py, with the services it calls stood in for by functions.
+"""
+
+import unittest
+
+import rpc_lib
+from rpc_servers import IssueProtobond
+
+def done(value):
+	future = rpc_lib.RPCFuture()
+	future.set_result("good", value)
+	return future
+
+class ProtobondStatsTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = {}
+		self.saved = (IssueProtobond.SellerDB, IssueProtobond.Check, IssueProtobond.Sign)
+		test = self
+		class SellerDB:
+			@staticmethod
+			def get_async(token):
+				return done(test.rows.get(token))
+			@staticmethod
+			def mark_protobond_sent_async(token, protobond):
+				test.rows[token]["protobond"] = protobond
+				return done(True)
+		class Check:
+			@staticmethod
+			def check_async(address, price):
+				return done(True)
+		class Sign:
+			@staticmethod
+			def sign(token):
+				return "signed " + token
+		IssueProtobond.SellerDB, IssueProtobond.Check, IssueProtobond.Sign = SellerDB, Check, Sign
+		IssueProtobond.protobonds.update(stored=0, signed=0, signing_seconds=0.0)
+
+	def tearDown(self):
+		IssueProtobond.SellerDB, IssueProtobond.Check, IssueProtobond.Sign = self.saved
+
+	def issue(self, token):
+		return rpc_lib.run_coroutine(IssueProtobond.issue_protobond(token=token))
+
+	def test_repeat_requests_are_counted_as_stored(self):
+		self.rows["token"] = {"protobond": None, "address": "1Address", "price": 65000, "paid": False}
+		for i in range(3):
+			self.assertEqual(self.issue("token"), "signed token")
+		stats = rpc_lib.report_stats()["extra"]["protobonds"]
+		self.assertEqual((stats["signed"], stats["stored"]), (1, 2))
+		self.assertAlmostEqual(stats["estimated_seconds_saved"], 2 * stats["signing_seconds"])
+
+if __name__ == "__main__":
+	unittest.main()
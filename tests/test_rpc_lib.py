@@ -0,0 +1,123 @@
+"""
+Tests for rpc_lib.py and rpc_eventloop.py, with both engines serving in this process.
+"""
+
+import os, shutil, socket, tempfile, threading, time, unittest
+
+import rpc_lib
+import rpc_eventloop
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def boom():
+	raise KeyError("boom")
+
+@rpc_lib.expose_rpc(concurrency=rpc_lib.PARALLEL)
+def slow(seconds):
+	time.sleep(seconds)
+	return "done"
+
+recorded = []
+@rpc_lib.expose_rpc
+def record(value):
+	recorded.append(value)
+	return value
+
+def start(server):
+	# The client's connections are never closed, so don't let the threaded server's handlers hold up exiting.
+	server.daemon_threads = True
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+class CodecTest(unittest.TestCase):
+	def test_round_trip(self):
+		row = {"address_index": 2**127 + 1, "address": "1Address", "price": 65000, "timestamp": 1400000000.0,
+			"protobond": None, "paid": False, "note": u"caf\xe9", "token": os.urandom(512)}
+		message = [1, "good", [row, True, -2**63, 2**63, {1: ["", u""]}]]
+		decoded = rpc_lib.decode_value(rpc_lib.encode_value(message))
+		self.assertEqual(decoded, message)
+		self.assertEqual(type(decoded[2][0]["token"]), str)
+		self.assertEqual(type(decoded[2][0]["note"]), unicode)
+
+	def test_malformed_frames(self):
+		for data in ["", "x", "i\x00", "b\x00\x00\x00\x05ab", "l\x00\x00\x00\x02N", "u\x00\x00\x00\x01\xff", "NN"]:
+			self.assertRaises(rpc_lib.ProtocolError, rpc_lib.decode_value, data)
+
+class MultiplexedErrorTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def serve(self, make_server):
+		path = os.path.join(self.directory, "test.sock")
+		rpc_lib.set_rpc_socket_path(path)
+		start(make_server(path))
+		return rpc_lib.RPCClient(path)
+
+	def check_failure_is_answered(self, client):
+		slow_call = client.call_async("slow", {"seconds": 0.2})
+		failing_call = client.call_async("boom", {})
+		self.assertRaisesRegexp(rpc_lib.RPCServerError, "KeyError", failing_call.result)
+		# The slow call was on the same connection, and must have been left to finish.
+		self.assertEqual(slow_call.result(), "done")
+		# Calls with bad arguments are answered too, and give back their slot on the connection.
+		for i in range(rpc_lib.MAX_IN_FLIGHT_PER_CONNECTION + 1):
+			self.assertRaisesRegexp(rpc_lib.RPCServerError, "TypeError", client.call_async("slow", {"nope": 1}).result)
+		self.assertEqual(client.call_async("slow", {"seconds": 0}).result(), "done")
+
+	def test_threaded_engine(self):
+		self.check_failure_is_answered(self.serve(rpc_lib.make_rpc_server))
+
+	def test_event_loop_engine(self):
+		self.check_failure_is_answered(self.serve(rpc_eventloop.EventLoopServer))
+
+class SealedRecordTest(unittest.TestCase):
+	def setUp(self):
+		self.saved_key = rpc_lib.global_rpc_key
+		rpc_lib.global_rpc_key = "k" * 64
+		del recorded[:]
+
+	def tearDown(self):
+		rpc_lib.global_rpc_key = self.saved_key
+
+	def check_tampered_record_is_rejected(self, port):
+		address = "tcp:127.0.0.1:%i" % port
+		rpc_lib.set_rpc_socket_path(address)
+		self.assertEqual(rpc_lib.RPCClient(address).call("record", {"value": "honest"}), "honest")
+		# Messages bigger than a record go in several, in every protocol version.
+		big = "x" * (2 * rpc_lib.MAX_RECORD_LEN + 1)
+		for version in (1, 2, 3):
+			client = rpc_lib.RPCClient(address, max_protocol_version=version)
+			self.assertEqual(client.call_async("record", {"value": big}).result(), big)
+			del recorded[1:]
+		# Authenticate, then send a request with one byte changed on the way.
+		sock = socket.create_connection(("127.0.0.1", port))
+		sock_file = sock.makefile()
+		keys = rpc_lib.authenticate_to_server(sock_file)
+		sealed_file = rpc_lib.SealedFile(sock_file, sock_file, keys, is_server=False)
+		sealed_file.write("%s2\n" % rpc_lib.HANDSHAKE_PREFIX)
+		sealed_file.flush()
+		self.assertEqual(sealed_file.readline(), "%s2\n" % rpc_lib.HANDSHAKE_PREFIX)
+		record = bytearray(sealed_file.sealer.seal(rpc_lib.BinaryProtocol(None, None).frame(["record", {"value": "sealed"}])))
+		record[-40] ^= 1
+		sock_file.write(str(record))
+		sock_file.flush()
+		# The server hangs up without running the request.
+		self.assertEqual(sealed_file.read(4), "")
+		self.assertEqual(recorded, ["honest"])
+		sealed_file.close()
+
+	def test_threaded_engine(self):
+		server = rpc_lib.make_rpc_server("tcp:127.0.0.1:0")
+		start(server)
+		self.check_tampered_record_is_rejected(server.server_address[1])
+
+	def test_event_loop_engine(self):
+		server = rpc_eventloop.EventLoopServer("tcp:127.0.0.1:0")
+		start(server)
+		self.check_tampered_record_is_rejected(server.sock.getsockname()[1])
+
+if __name__ == "__main__":
+	unittest.main()
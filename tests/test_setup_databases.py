@@ -0,0 +1,51 @@
+"""
+Tests for setup_databases.py. Run from the top of the repository with: python -m unittest discover tests
+"""
+
+import base64, os, shutil, sqlite3, tempfile, unittest
+
+import db_lib, setup_databases
+
+class RebuildRedeemerTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "redeemer_database.db")
+		# The redeemer table as it was before it had a state, keyed by the bond itself.
+		con = sqlite3.connect(self.path)
+		con.execute("create table transactions (bond text primary key, address text, fulfilled integer)")
+		self.con = con
+
+	def tearDown(self):
+		self.con.close()
+		shutil.rmtree(self.directory)
+
+	def rows(self):
+		con = sqlite3.connect(self.path)
+		rows = con.execute("select digest, bond, address, fulfilled, state from transactions order by rowid").fetchall()
+		con.close()
+		return rows
+
+	def test_duplicate_bonds_keep_the_fulfilled_row(self):
+		bond = base64.b64encode(hex(2**300 + 21))
+		other = base64.b64encode(hex(2**300 + 22))
+		# The same bond, once in the old hex format and once as a BLOB, as a partial migration can leave it.
+		self.con.execute("insert into transactions values (?, ?, ?)", (bond.encode("hex"), "1First", 0))
+		self.con.execute("insert into transactions values (?, ?, ?)", (db_lib.blob(bond), "1Second", 1))
+		self.con.execute("insert into transactions values (?, ?, ?)", (other.encode("hex"), "1Other", 0))
+		self.con.commit()
+		setup_databases.upgrade_redeemer(self.path)
+		rows = self.rows()
+		self.assertEqual([(str(row[1]), row[2], row[3], row[4]) for row in rows],
+			[(bond, "1Second", 1, "fulfilled"), (other, "1Other", 0, "unfulfilled")])
+		self.assertEqual(str(rows[0][0]), str(db_lib.bond_digest(bond)))
+
+	def test_duplicate_bonds_keep_the_first_row_otherwise(self):
+		bond = base64.b64encode(hex(2**300 + 21))
+		self.con.execute("insert into transactions values (?, ?, ?)", (bond.encode("hex"), "1First", 0))
+		self.con.execute("insert into transactions values (?, ?, ?)", (db_lib.blob(bond), "1Second", 0))
+		self.con.commit()
+		setup_databases.upgrade_redeemer(self.path)
+		self.assertEqual([row[2] for row in self.rows()], ["1First"])
+
+if __name__ == "__main__":
+	unittest.main()